@@ -0,0 +1,278 @@
+"""
+Benchmarks for the analyzer.
+
+This generates synthetic queries and measures, for each of them, the
+time spent in the successive phases of handle_sql(): parsing,
+analysis, compaction, exploration and rendering. It also measures the
+time to start sql.py as a command and process a single query.
+
+It can be launched with
+
+   python3 bench.py [-n N] [-o results.json] [--compare baseline.json]
+
+The results are printed, and optionally saved as JSON so that a later
+run can be compared against them: phases that became slower than the
+baseline by more than the threshold are reported, and the exit status
+is then non-zero.
+"""
+
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import catalog
+from sqlio import loads
+from scope import scope
+from memo import memo, memo_as_string, print_tree, compact
+from sql import analyze_select, explore
+
+# The number of columns in each synthetic table.
+ncols = 4
+
+def tablename(level, i):
+    """The name of the i-th synthetic table used at the given nesting level.
+
+    Each nesting level uses its own tables, so that the names defined
+    by an outer query are not shadowed by those of its subqueries.
+    """
+    tn = 't%d_%d' % (level, i)
+    if tn not in catalog.tables:
+        catalog.tables[tn] = tuple('c%d' % j for j in range(ncols))
+    return tn
+
+def genquery(width=2, fromlen=1, depth=0, correlated=False, seed=0):
+    """Generate a synthetic query.
+
+    The arguments are as follows:
+    - width: the number of projections.
+    - fromlen: the number of tables in each FROM clause.
+    - depth: the number of nested subqueries in the WHERE clause.
+    - correlated: whether the subqueries refer to the enclosing query.
+    - seed: the seed of the random choices (columns, operators).
+
+    >>> genquery(width=2, fromlen=2)
+    '(select :exprs [(- t0_1.c2 t0_0.c0) (- t0_1.c3 t0_1.c2)] :from [t0_0 t0_1])'
+    >>> genquery(width=1, depth=1, correlated=True, seed=2)
+    '(select :exprs [(+ t0_0.c0 t0_0.c0)] :from t0_0 :where (= t0_0.c1 (select :exprs [(- t1_0.c1 t1_0.c2)] :from t1_0 :where (= t1_0.c2 t0_0.c1))))'
+    """
+    return _genselect(random.Random(seed), width, fromlen, depth, correlated, 0, None)
+
+# Helper function for genquery().
+def _genselect(rng, width, fromlen, depth, correlated, level, outer):
+    tns = [tablename(level, i) for i in range(fromlen)]
+    cols = ['%s.c%d' % (tn, j) for tn in tns for j in range(ncols)]
+    exprs = ['(%s %s %s)' % (rng.choice('+-*'), rng.choice(cols), rng.choice(cols))
+             for _ in range(width)]
+    if fromlen == 1:
+        frm = tns[0]
+    else:
+        frm = '[%s]' % ' '.join(tns)
+    q = '(select :exprs [%s] :from %s' % (' '.join(exprs), frm)
+
+    where = None
+    if depth > 0:
+        sub = _genselect(rng, 1, fromlen, depth-1, correlated, level+1, cols)
+        if rng.random() < 0.5:
+            where = '(exists %s)' % sub
+        else:
+            where = '(= %s %s)' % (rng.choice(cols), sub)
+    if correlated and outer is not None:
+        cond = '(= %s %s)' % (rng.choice(cols), rng.choice(outer))
+        where = cond if where is None else '(and %s %s)' % (cond, where)
+    if where is not None:
+        q += ' :where ' + where
+    return q + ')'
+
+# The configurations measured by default.
+suite = [
+    {'name': 'narrow', 'width': 2, 'fromlen': 1, 'depth': 0},
+    {'name': 'wide', 'width': 64, 'fromlen': 1, 'depth': 0},
+    {'name': 'cross', 'width': 8, 'fromlen': 8, 'depth': 0},
+    {'name': 'nested', 'width': 4, 'fromlen': 2, 'depth': 8},
+    {'name': 'correlated', 'width': 4, 'fromlen': 2, 'depth': 8, 'correlated': True},
+]
+
+# The phases measured for each query, in order.
+phases = ['parse', 'analyze', 'compact', 'explore', 'memo_as_string', 'print_tree']
+
+def run_query(text, times=None):
+    """Process one query through all the phases.
+
+    If times is specified, it is a dictionary from phase name to a list
+    where the duration of each phase is appended.
+    """
+    def timed(phase, f, *args):
+        start = time.perf_counter()
+        ret = f(*args)
+        if times is not None:
+            times[phase].append(time.perf_counter() - start)
+        return ret
+
+    q = timed('parse', loads, text)
+    m = memo()
+    m.root = timed('analyze', analyze_select, m, scope(None), q)
+    timed('compact', compact, m)
+    timed('explore', explore, m)
+    timed('memo_as_string', memo_as_string, m)
+    with contextlib.redirect_stdout(io.StringIO()):
+        timed('print_tree', print_tree, m)
+
+def percentile(values, p):
+    """Return the p-th percentile of a list of values.
+
+    >>> percentile([3, 1, 2, 4], 50)
+    2
+    >>> percentile([3, 1, 2, 4], 99)
+    4
+    """
+    values = sorted(values)
+    return values[max(0, math.ceil(len(values)*p/100) - 1)]
+
+def run_config(config, n):
+    """Measure one configuration over n generated queries."""
+    params = dict((k, v) for k, v in config.items() if k != 'name')
+    queries = [genquery(seed=i, **params) for i in range(n)]
+
+    # First pass: measure latencies.
+    times = dict((p, []) for p in phases)
+    for q in queries:
+        run_query(q, times)
+
+    # Second pass: measure peak memory. This is done separately
+    # because tracemalloc slows down everything else.
+    tracemalloc.start()
+    for q in queries:
+        run_query(q)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    res = {'queries': n, 'peak_kib': peak // 1024}
+    for p in phases:
+        res[p] = timings(times[p])
+    return res
+
+def timings(t):
+    """Summarize a list of durations."""
+    return {
+        'throughput': len(t) / sum(t),
+        'p50_us': percentile(t, 50) * 1e6,
+        'p90_us': percentile(t, 90) * 1e6,
+        'p99_us': percentile(t, 99) * 1e6,
+    }
+
+# The inputs used to measure the startup time of sql.py.
+startup_inputs = {
+    'empty': '',
+    'query': '(select :exprs k :from kv :where (= v 20))\n',
+}
+
+def run_startup(n):
+    """Measure the time to run sql.py as a command, n times per input."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql.py')
+    res = {}
+    for name, text in startup_inputs.items():
+        t = []
+        for _ in range(n):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script], input=text.encode(),
+                           stdout=subprocess.DEVNULL, check=True)
+            t.append(time.perf_counter() - start)
+        res[name] = timings(t)
+    return res
+
+def run_suite(n, configs=None):
+    """Measure all the configurations of the suite."""
+    if configs is None:
+        configs = suite
+    results = dict((c['name'], run_config(c, n)) for c in configs)
+    # Starting a process is much slower than analyzing a query,
+    # so measure fewer of them.
+    results['startup'] = run_startup(max(1, n // 10))
+    return {
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+
+def print_results(results):
+    """Print the results as a table."""
+    print('%-12s %-15s %12s %10s %10s %10s' %
+          ('config', 'phase', 'queries/s', 'p50(us)', 'p90(us)', 'p99(us)'))
+    for name, res in results['results'].items():
+        for p, r in res.items():
+            if not isinstance(r, dict):
+                continue
+            print('%-12s %-15s %12.0f %10.1f %10.1f %10.1f' %
+                  (name, p, r['throughput'], r['p50_us'], r['p90_us'], r['p99_us']))
+        if 'peak_kib' in res:
+            print('%-12s %-15s %12d KiB' % (name, 'peak memory', res['peak_kib']))
+
+def compare(results, baseline, threshold):
+    """Compare results against a baseline.
+
+    The return value is the list of (config, phase, ratio) for which
+    the median latency increased by more than the threshold (a
+    fraction, e.g. 0.1 for 10%).
+
+    >>> old = {'results': {'a': {'parse': {'p50_us': 10.0}}}}
+    >>> new = {'results': {'a': {'parse': {'p50_us': 15.0}}}}
+    >>> compare(new, old, 0.1)
+    [('a', 'parse', 1.5)]
+    >>> compare(old, new, 0.1)
+    []
+    """
+    slower = []
+    for name, res in results['results'].items():
+        base = baseline['results'].get(name, None)
+        if base is None:
+            continue
+        for p, r in res.items():
+            if not isinstance(r, dict) or p not in base:
+                continue
+            ratio = r['p50_us'] / base[p]['p50_us']
+            if ratio > 1 + threshold:
+                slower.append((name, p, ratio))
+    return slower
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the analyzer.')
+    parser.add_argument('-n', type=int, default=200,
+                        help='number of queries per configuration')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='compare against JSON results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='tolerated slowdown when comparing (default 0.1)')
+    parser.add_argument('--test', action='store_true', help='run the self-tests')
+    args = parser.parse_args(argv)
+
+    if args.test:
+        print("testing...")
+        import doctest
+        doctest.testmod()
+        print("testing done")
+        return 0
+
+    results = run_suite(args.n)
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.threshold)
+        for name, p, ratio in slower:
+            print("SLOWER: %s %s: %.2fx" % (name, p, ratio))
+        if len(slower) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,64 @@
+import math
+
+class bloom(object):
+    """An object that represents a Bloom filter.
+
+    A Bloom filter summarizes a set of values in a bit array. Testing
+    whether a value is in the filter can give false positives, but
+    never false negatives.
+
+    The size of the bit array and the number of hash functions are
+    chosen from the expected number of values, so that the rate of
+    false positives stays below fpp.
+
+    >>> b = bloom(100)
+    >>> for i in range(100):
+    ...     b.add(i * 3)
+    >>> all(i * 3 in b for i in range(100))
+    True
+    >>> sum(1 for i in range(100000) if i * 3 + 1 in b) < 2000
+    True
+    """
+    def __init__(self, n, fpp=0.01):
+        n = max(n, 1)
+        nbits = -n * math.log(fpp) / (math.log(2) ** 2)
+        self.nhashes = max(1, int(round(-math.log(fpp) / math.log(2))))
+        # Round the size up to a power of two: with an odd step, the
+        # double hashing below then never cycles on a few bits.
+        self.nbits = 1 << max(3, int(math.ceil(math.log2(nbits))))
+        self.bits = bytearray(self.nbits >> 3)
+
+    def _positions(self, v):
+        # Double hashing: derive all the hash functions from two
+        # halves of a well-mixed hash of the value. Python's own
+        # hash is the identity on small integers, so mix it first.
+        h = mix(hash(v))
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) & (self.nbits - 1)
+
+    def add(self, v):
+        for p in self._positions(v):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, v):
+        for p in self._positions(v):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+_mask64 = (1 << 64) - 1
+
+def mix(x):
+    """Scramble the bits of an integer into a 64-bit hash (splitmix64)."""
+    x = (x + 0x9e3779b97f4a7c15) & _mask64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _mask64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _mask64
+    return x ^ (x >> 31)
+
+if __name__ == "__main__":
+    import doctest
+    print("testing...")
+    doctest.testmod()
+    print("testing done")
@@ -0,0 +1,132 @@
+"""
+A cache for the results of queries.
+
+Results are keyed by the fingerprint of the plan (see
+memo.fingerprint()) and the values bound to its placeholders. Each
+entry remembers the version of the tables read by the plan when it
+was computed; it is discarded as soon as one of them changes (see
+catalog.bump()).
+
+The cache holds at most a given number of bytes of results. When it
+is full, the least recently used results are evicted first.
+
+Example:
+
+>>> import catalog
+>>> from sql import analyze, loads
+>>> c = resultcache(1 << 20)
+>>> m = analyze(loads('(select :exprs k :from kv :where (> v (param 1)))'))
+>>> c.execute(m, (25,)), c.hits, c.misses
+([(4,), (5,)], 0, 1)
+>>> c.execute(analyze(loads('(select :exprs k :from kv :where (> v (param 1)))')), (25,)), c.hits
+([(4,), (5,)], 1)
+>>> c.execute(m, (35,)), c.misses
+([(5,)], 2)
+>>> catalog.bump('kv')
+>>> c.execute(m, (25,)), c.misses
+([(4,), (5,)], 3)
+
+The callers get their own copy of the cached rows:
+
+>>> c.execute(m, (25,)).clear()
+>>> c.execute(m, (25,)), c.hits
+([(4,), (5,)], 3)
+"""
+
+import collections
+import sys
+
+import catalog
+import prof
+import run
+from memo import fingerprint, scantables
+
+class entry(object):
+    """A cached result.
+
+    - rows: the result rows, as a tuple.
+    - versions: the version of each table read, when computed.
+    - size: the estimated size of the rows in bytes.
+    """
+    def __init__(self, rows, versions, size):
+        self.rows = rows
+        self.versions = versions
+        self.size = size
+
+class resultcache(object):
+    """An object that caches query results, within a budget in bytes.
+
+    The results that are not cached are computed with execute, a
+    function like run.execute().
+    """
+    def __init__(self, budget, execute=run.execute):
+        self.budget = budget
+        self.compute = execute
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return a copy of the cached rows for a key, or None."""
+        e = self.entries.get(key, None)
+        if e is None:
+            return None
+        if any(catalog.version(tn) != v for tn, v in e.versions.items()):
+            # Some table has changed since.
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return list(e.rows)
+
+    def put(self, key, rows, tables):
+        """Store the rows for a key, computed from the given tables."""
+        if key in self.entries:
+            self.remove(key)
+        size = rowsize(rows)
+        if size > self.budget:
+            return
+        while self.size + size > self.budget:
+            self.remove(next(iter(self.entries)))
+        # The rows are kept as a tuple, so that they cannot be changed.
+        self.entries[key] = entry(tuple(rows), dict((tn, catalog.version(tn)) for tn in tables), size)
+        self.size += size
+
+    def remove(self, key):
+        self.size -= self.entries.pop(key).size
+
+    def execute(self, m, params=()):
+        """Execute the plan in memo m, or return its cached results."""
+        key = (fingerprint(m, m.root), tuple(params))
+        rows = self.get(key)
+        if rows is not None:
+            self.hits += 1
+            prof.count('cache.hits')
+            return rows
+        self.misses += 1
+        prof.count('cache.misses')
+        # Note the versions before executing, so that a change during
+        # the execution invalidates the result.
+        tables = scantables(m, m.root)
+        versions = dict((tn, catalog.version(tn)) for tn in tables)
+        rows = self.compute(m, params=params)
+        if all(catalog.version(tn) == v for tn, v in versions.items()):
+            self.put(key, rows, tables)
+        return rows
+
+def rowsize(rows):
+    """Estimate the size in bytes of a list of rows.
+
+    >>> rowsize([]) < rowsize([(1, 2)]) < rowsize([(1, 2), (3, 4)])
+    True
+    """
+    size = sys.getsizeof(rows)
+    for r in rows:
+        size += sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r)
+    return size
+
+if __name__ == "__main__":
+    print("testing...")
+    import doctest
+    doctest.testmod()
+    print("testing done")
@@ -0,0 +1,178 @@
+"""
+The catalog describes the tables known to the analyzer: their schema,
+their data and the sorted secondary indexes declared over their
+columns.
+
+Indexes are built and persisted offline, with
+
+   python3 catalog.py build
+
+and loaded back from disk (or rebuilt in memory if they have not been
+persisted yet) the first time a query uses them.
+"""
+
+import bisect
+import os.path
+
+# tables is the list of tables known for the purpose
+# of schema resolution in FROM clauses.
+tables = {
+    # ... Some fake table schema ...
+    # (for testing)
+    'kv': ('k', 'v'),
+    'ab': ('a', 'b'),
+}
+
+# data holds the rows of each table, stored column-wise in the same
+# order as the schema above.
+data = {
+    # ... Some fake table data ...
+    # (for testing)
+    'kv': ([1, 2, 3, 4, 5], [10, 20, 20, 30, 40]),
+    'ab': ([1, 2, 3], [10, 20, 30]),
+}
+
+# indexes lists, for each table, the columns over which a sorted
+# secondary index is declared.
+indexes = {
+    'kv': ('v',),
+}
+
+# versions holds the version of the data of each table. It must be
+# bumped, with bump(), every time the data of a table changes.
+versions = {}
+
+def version(tn):
+    """The current version of the data of a table."""
+    return versions.get(tn, 0)
+
+def bump(tn):
+    """Record that the data of a table has changed.
+
+    >>> v = version('kv')
+    >>> bump('kv')
+    >>> version('kv') == v + 1
+    True
+    """
+    versions[tn] = version(tn) + 1
+    # The indexes loaded in memory are now stale.
+    for k in [k for k in _loaded if k[0] == tn]:
+        del _loaded[k]
+
+# indexdir is where the indexes are persisted.
+indexdir = os.path.expanduser("~/.sqlidx")
+
+class sortedindex(object):
+    """An object that represents a sorted secondary index.
+
+    An index is a list of keys in sorted order, together with the
+    positions of the corresponding rows in the table. NULL values are
+    left out: no range includes them.
+
+    >>> i = sortedindex([30, 10, 20, 20])
+    >>> i.keys, i.rowids
+    ([10, 20, 20, 30], [1, 2, 3, 0])
+    >>> i.lookup(20, 20)
+    [2, 3]
+    >>> i.lookup(10, 30, '[)')
+    [1, 2, 3]
+    >>> i.lookup(None, 20, '()')
+    [1]
+    >>> i.lookup(20, None, '(]')
+    [0]
+    >>> sortedindex([10, None, 30]).lookup(None, None)
+    [0, 2]
+    """
+    def __init__(self, col, version=0):
+        # The version of the table data the index was built from.
+        self.version = version
+        order = sorted((i for i in range(len(col)) if col[i] is not None), key=lambda i: col[i])
+        self.keys = [col[i] for i in order]
+        self.rowids = order
+
+    def lookup(self, lo, hi, bounds='[]'):
+        """Return the positions of the rows whose key lies between lo and hi.
+
+        A bound set to None is open-ended. The bounds string says, in
+        interval notation, whether lo and hi are included.
+        """
+        if lo is None:
+            start = 0
+        elif bounds[0] == '[':
+            start = bisect.bisect_left(self.keys, lo)
+        else:
+            start = bisect.bisect_right(self.keys, lo)
+        if hi is None:
+            end = len(self.keys)
+        elif bounds[1] == ']':
+            end = bisect.bisect_right(self.keys, hi)
+        else:
+            end = bisect.bisect_left(self.keys, hi)
+        return self.rowids[start:end]
+
+def has_index(tn, colname):
+    """Whether a sorted index is declared over the given column."""
+    return colname in indexes.get(tn, ())
+
+def index_path(tn, colname):
+    """The file where the index over the given column is persisted."""
+    return os.path.join(indexdir, '%s.%s.idx' % (tn, colname))
+
+def build_index(tn, colname):
+    """Build the index over the given column from the table data."""
+    return sortedindex(data[tn][tables[tn].index(colname)], version(tn))
+
+def save_index(tn, colname, idx):
+    """Persist an index to disk."""
+    import pickle
+    os.makedirs(indexdir, exist_ok=True)
+    with open(index_path(tn, colname), 'wb') as f:
+        pickle.dump(idx, f)
+
+# _loaded caches the indexes already loaded by get_index().
+_loaded = {}
+
+def get_index(tn, colname):
+    """Retrieve the index over the given column for use at execution time.
+
+    The persisted index is only used if it was built from the current
+    version of the table data:
+
+    >>> import catalog, tempfile
+    >>> catalog.indexdir = tempfile.mkdtemp()
+    >>> catalog.tables['t'], catalog.data['t'] = ('x',), ([3, 1, 2],)
+    >>> catalog.save_index('t', 'x', catalog.build_index('t', 'x'))
+    >>> catalog.data['t'] = ([5, 4],)
+    >>> catalog.bump('t')
+    >>> catalog.get_index('t', 'x').keys
+    [4, 5]
+    """
+    idx = _loaded.get((tn, colname), None)
+    if idx is None:
+        path = index_path(tn, colname)
+        if os.path.exists(path):
+            import pickle
+            with open(path, 'rb') as f:
+                idx = pickle.load(f)
+        if idx is None or getattr(idx, 'version', None) != version(tn):
+            # Not persisted yet, or stale: build it in memory.
+            idx = build_index(tn, colname)
+        _loaded[(tn, colname)] = idx
+    return idx
+
+def build_all():
+    """Build and persist all the declared indexes."""
+    for tn, cols in indexes.items():
+        for colname in cols:
+            save_index(tn, colname, build_index(tn, colname))
+            print("built", index_path(tn, colname))
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ['build']:
+        build_all()
+    else:
+        print("testing...")
+        import doctest
+        doctest.testmod()
+        print("testing done")
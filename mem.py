@@ -0,0 +1,235 @@
+"""
+Memory accounting for the analyzer.
+
+The size of the data structures (parse trees, memos) is estimated
+structurally, by adding up the sizes of all the objects they contain.
+Each object is counted once, even if it is shared.
+
+The memory allocated while processing a query can also be tracked
+with tracemalloc, see tracking() below. This is slower, so it is only
+enabled on demand (with \\mem in the shell).
+
+Finally, a memory budget can be set to abort the analysis of queries
+whose memo grows too large, before the process runs out of memory.
+"""
+
+import contextlib
+import sys
+
+# budget, if not None, is the maximum estimated size in bytes of the
+# classes of a memo. See charge() below.
+budget = None
+
+# The report being collected, if tracking is enabled.
+_current = None
+
+def sizeof(obj, seen=None):
+    """Estimate the size in bytes of an object and the objects it contains.
+
+    The objects whose id is in seen are not counted again; the ids of
+    the objects counted are added to it.
+
+    >>> sizeof([]) < sizeof([[]])
+    True
+    >>> a = [1000]
+    >>> sizeof([a, a]) < sizeof([a]) + sizeof(a)
+    True
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += sizeof(k, seen) + sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += sizeof(v, seen)
+    if hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, seen)
+    return size
+
+def measure(obj):
+    """Return the number of objects in an object, and their size in bytes.
+
+    >>> from sqlio import loads
+    >>> n, size = measure(loads('(+ 1 2)'))
+    >>> n > 3, size > 0
+    (True, True)
+    """
+    seen = set()
+    size = sizeof(obj, seen)
+    return len(seen), size
+
+def usage(m):
+    """Return the memory usage of the classes of a memo, per operator.
+
+    The result is a dictionary from the operator of the first
+    m-expression of the classes to a list [number of classes, bytes].
+
+    >>> from memo import memo
+    >>> from sqlio import Exp
+    >>> m = memo()
+    >>> a = m.newcls(Exp('lit', [1]), {})
+    >>> b = m.newcls(Exp('lit', [2]), {})
+    >>> m.root = m.newcls(Exp('+', [a, b]), {})
+    >>> u = usage(m)
+    >>> sorted(u), u['lit'][0], u['+'][0]
+    (['+', 'lit'], 2, 1)
+    """
+    seen = set()
+    res = {}
+    for c in m.classes:
+        u = res.setdefault(c.mexprs[0].op, [0, 0])
+        u[0] += 1
+        u[1] += sizeof(c, seen)
+    return res
+
+def charge(m, c):
+    """Account for a new class in a memo, and enforce the memory budget.
+
+    >>> import mem
+    >>> from memo import memo
+    >>> from sqlio import Exp
+    >>> mem.budget = 1000
+    >>> m = memo()
+    >>> for i in range(100):
+    ...     idx = m.newcls(Exp('lit', [i]), {})
+    Traceback (most recent call last):
+    ...
+    MemoryError: the memo exceeds the memory budget (1000 bytes)
+    >>> mem.budget = None
+    """
+    m.size += classsize(c)
+    if budget is not None and m.size > budget:
+        raise MemoryError("the memo exceeds the memory budget (%d bytes)" % budget)
+
+def classsize(c):
+    """Quickly estimate the size in bytes of a class.
+
+    Only the containers are counted, not the values they contain (which
+    are mostly small integers and names shared with other classes).
+
+    >>> from memo import cls
+    >>> from sqlio import Exp
+    >>> classsize(cls(Exp('lit', [1]))) <= sizeof(cls(Exp('lit', [1])))
+    True
+    """
+    size = sys.getsizeof(c) + sys.getsizeof(c.__dict__) + sys.getsizeof(c.mexprs) + sys.getsizeof(c.props)
+    for e in c.mexprs:
+        size += sys.getsizeof(e) + sys.getsizeof(e.args)
+    for v in c.props.values():
+        # Set values keep their elements in a set.
+        size += sys.getsizeof(getattr(v, '_val', v))
+    return size
+
+class report(object):
+    """An object that collects the memory usage for one query.
+
+    - exp: the number of objects and bytes of the parse tree.
+    - memo: the usage of the memo, per operator (see usage()).
+    - allocated: the bytes allocated and not freed during the query.
+    - peak: the maximum bytes allocated at any time during the query.
+    - top: the source lines that allocated the most memory, as a list
+      of (file:line, bytes, number of blocks).
+    """
+    def __init__(self):
+        self.exp = None
+        self.memo = None
+        self.allocated = 0
+        self.peak = 0
+        self.top = []
+
+def note_exp(exp):
+    """Record the size of a parse tree in the current report, if any."""
+    r = _current
+    if r is not None:
+        r.exp = measure(exp)
+
+def note_memo(m):
+    """Record the usage of a memo in the current report, if any."""
+    r = _current
+    if r is not None:
+        r.memo = usage(m)
+
+@contextlib.contextmanager
+def tracking(sink, ntop=5):
+    """Track the memory allocated for the duration of the context.
+
+    The report is sent to the sink at the end, even if an exception
+    was raised.
+
+    >>> class sink(object):
+    ...     def emit(self, r):
+    ...         self.r = r
+    >>> s = sink()
+    >>> with tracking(s):
+    ...     x = [[i] for i in range(1000)]
+    >>> s.r.peak >= s.r.allocated > 0, len(s.r.top) > 0
+    (True, True)
+    """
+    import tracemalloc
+    global _current
+    prev = _current
+    r = report()
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    base = tracemalloc.get_traced_memory()[0]
+    _current = r
+    try:
+        yield r
+    finally:
+        _current = prev
+        cur, peak = tracemalloc.get_traced_memory()
+        r.allocated, r.peak = cur - base, peak - base
+        after = tracemalloc.take_snapshot()
+        if started:
+            tracemalloc.stop()
+        for d in after.compare_to(before, 'lineno')[:ntop]:
+            if d.size_diff > 0:
+                f = d.traceback[0]
+                r.top.append(('%s:%d' % (f.filename.rsplit('/', 1)[-1], f.lineno), d.size_diff, d.count_diff))
+        sink.emit(r)
+
+class printsink(object):
+    """A sink that prints the memory reports to the screen.
+
+    >>> r = report()
+    >>> r.exp = (12, 960)
+    >>> r.memo = {'scan': [1, 500], 'var': [2, 700]}
+    >>> r.allocated, r.peak = 4096, 8192
+    >>> r.top = [('memo.py:67', 2048, 10)]
+    >>> printsink().emit(r)
+    memory:
+      parse tree              960 B     12 objects
+      memo                   1200 B      3 classes
+        scan                  500 B      1 classes
+        var                   700 B      2 classes
+      allocated              4096 B
+      peak                   8192 B
+      memo.py:67             2048 B     10 blocks
+    """
+    def emit(self, r):
+        print("memory:")
+        if r.exp is not None:
+            print("  %-20s %6d B %6d objects" % ('parse tree', r.exp[1], r.exp[0]))
+        if r.memo is not None:
+            print("  %-20s %6d B %6d classes" % ('memo', sum(u[1] for u in r.memo.values()),
+                                                  sum(u[0] for u in r.memo.values())))
+            for op in sorted(r.memo):
+                print("    %-18s %6d B %6d classes" % (op, r.memo[op][1], r.memo[op][0]))
+        print("  %-20s %6d B" % ('allocated', r.allocated))
+        print("  %-20s %6d B" % ('peak', r.peak))
+        for site, size, count in r.top:
+            print("  %-20s %6d B %6d blocks" % (site, size, count))
+
+if __name__ == "__main__":
+    import doctest
+    print("testing...")
+    doctest.testmod()
+    print("testing done")
@@ -1,7 +1,9 @@
-import sexpdata
 import io
 from show import show
-from sqlio import Exp, Props
+import sqlio
+from sqlio import Exp, Props, Set, dumps
+import prof
+import mem
 
 class cls(object):
     """An object that represents an expression class.
@@ -14,7 +16,10 @@ class cls(object):
 
     This implementation is intended for use together with sqlio.Props
     for properties. Any m-expression and property type that can render
-    as a S-expression (via sexpdata.dumps) can be used.
+    as a S-expression (via sqlio.dumps) can be used.
+
+    The rendering of a class is cached until its properties (or the
+    sets among them) change, or an m-expression is added.
 
     Examples:
 
@@ -22,6 +27,13 @@ class cls(object):
     <cls (+)                                      ()>
     >>> cls(Exp('+', [1, 2]), {'a': 1, 'b': 2})
     <cls (+ 1 2)                                  (:a 1 :b 2)>
+    >>> from sqlio import Set
+    >>> c = cls(Exp('var', ['kv.k']), {'neededcols': Set([0])})
+    >>> c
+    <cls (var "kv.k")                             (:neededcols {0})>
+    >>> c.props.neededcols.add(1)
+    >>> c
+    <cls (var "kv.k")                             (:neededcols {0 1})>
     """
     def __init__(self, mexpr, props=None):
         if props is None:
@@ -30,10 +42,19 @@ class cls(object):
             props = Props(props)
         self.props = props
         self.mexprs = [mexpr]
+        self._repr = None
+        # The fingerprint of the class, once computed.
+        self._fp = None
 
     def __repr__(self):
-        return "<cls %-40s %s>" % (' '.join(sexpdata.dumps(e) for e in self.mexprs),
-                                    sexpdata.dumps(self.props))
+        # The lists and Props compare as identical when they were not
+        # replaced, and the counters tell whether they were changed.
+        key = (self.mexprs, len(self.mexprs), self.props, self.props._mutations,
+               tuple(v._mutations for v in self.props.values() if isinstance(v, sqlio.Set)))
+        if self._repr is None or self._repr[0] != key:
+            self._repr = (key, "<cls %-40s %s>" % (' '.join([dumps(e) for e in self.mexprs]),
+                                                   dumps(self.props)))
+        return self._repr[1]
 
 class memo(object):
     """An object that represents a memo.
@@ -56,37 +77,416 @@ class memo(object):
     """
     def __init__(self):
         self.root = None
+        # roots, if not None, lists the roots of the queries of a batch
+        # analyzed into this memo (see merge() below). root is then None.
+        self.roots = None
         self.classes = []
+        # shared maps the fingerprints of uncorrelated subqueries to
+        # the index of their class, so that identical subqueries can
+        # share it.
+        self.shared = {}
+        # size is the estimated size of the classes in bytes. It is
+        # only maintained while a memory budget is set (see mem.py).
+        self.size = 0
 
     def __getitem__(self, idx):
         """A memo supports the m[idx] notation."""
         return self.classes[idx]
 
     def newcls(self, item, props):
-        self.classes.append(cls(item, props))
+        prof.count('classes.' + item.op)
+        c = cls(item, props)
+        if mem.budget is not None:
+            mem.charge(self, c)
+        self.classes.append(c)
         return len(self.classes)-1
 
     def __repr__(self):
         return memo_as_string(self)
 
+# leafops are the operators whose m-expression arguments are not
+# memo indexes.
+leafops = ['lit', 'var', 'param', 'scan', 'indexscan', 'unary']
+
+def refs(m, idx, alts=False):
+    """The indexes of the classes referenced by a class.
+
+    These are the arguments of its m-expression, and the columns it
+    outputs if it is a relational class. If alts is True, the arguments
+    of all its m-expressions are included, not only the first one.
+    """
+    res = []
+    for e in (m[idx].mexprs if alts else m[idx].mexprs[:1]):
+        if e.op not in leafops and e.args is not None:
+            res.extend(e.args)
+    if m[idx].props.cols is not None:
+        res.extend(m[idx].props.cols)
+    return res
+
+def fingerprint(m, idx):
+    """Compute a fingerprint of the expression rooted at a class.
+
+    Two expressions have the same fingerprint if they have the same
+    structure, regardless of the position of their classes in the memo.
+
+    >>> m1, m2 = memo(), memo()
+    >>> m2.newcls(Exp('lit', [0]), {})
+    0
+    >>> for m in m1, m2:
+    ...     a = m.newcls(Exp('lit', [123]), {})
+    ...     m.root = m.newcls(Exp('-', [a, a]), {})
+    >>> fingerprint(m1, m1.root) == fingerprint(m2, m2.root)
+    True
+    >>> fingerprint(m1, m1.root) == fingerprint(m1, 0)
+    False
+
+    Variables with the same name are different columns if they are
+    different classes:
+
+    >>> m = memo()
+    >>> x = m.newcls(Exp('var', ['kv.k']), {})
+    >>> y = m.newcls(Exp('var', ['kv.k']), {})
+    >>> fingerprint(m, m.newcls(Exp('-', [x, y]), {})) == fingerprint(m, m.newcls(Exp('-', [x, x]), {}))
+    False
+
+    The fingerprint of each class is computed once, from those of the
+    classes it refers to, and kept in the class.
+    """
+    return _fingerprint(m, idx)[0]
+
+# Helper function for fingerprint(). The result is a hash of the
+# structure of the expression, and the list of the variables it uses
+# (that can be used outside of it) in the order they are first used.
+# The hash of each class includes,
+# for each class it refers to, which of its own variables they use, so
+# that it tells apart expressions that only differ in which variables
+# are the same.
+def _fingerprint(m, idx):
+    c = m[idx]
+    if c._fp is not None:
+        return c._fp
+    import hashlib
+    e = c.mexprs[0]
+    if e.op == 'var':
+        c._fp = (hashlib.sha1(dumps(e).encode()).hexdigest(), (idx,))
+        return c._fp
+    refs = [] if e.op in leafops or e.args is None else list(e.args)
+    parts = [dumps(e) if e.op in leafops else e.op]
+    if c.props.cols is not None:
+        refs.append(None)
+        refs.extend(c.props.cols)
+    vars, pos = [], {}
+    for i in refs:
+        if i is None:
+            parts.append('|')
+            continue
+        h, used = _fingerprint(m, i)
+        for v in used:
+            if v not in pos:
+                pos[v] = len(vars)
+                vars.append(v)
+        parts.append('%s%s' % (h, [pos[v] for v in used]))
+    if c.props.cols is not None:
+        # Outside of a relational expression, only the variables used by
+        # its columns, and those it needs, can be referred to.
+        keep = set(c.props.neededcols)
+        for i in c.props.cols:
+            keep.update(_fingerprint(m, i)[1])
+        vars = [v for v in vars if v in keep]
+    c._fp = (hashlib.sha1(' '.join(parts).encode()).hexdigest(), tuple(vars))
+    return c._fp
+
+def scantables(m, idx):
+    """The set of tables read by the expression rooted at a class."""
+    res, seen, todo = set(), set(), [idx]
+    while len(todo) > 0:
+        i = todo.pop()
+        if i in seen:
+            continue
+        seen.add(i)
+        for e in m[i].mexprs:
+            if e.op == 'scan':
+                res.add(e.args[0])
+            elif e.op == 'indexscan':
+                res.add(e.args.table)
+        todo.extend(refs(m, i, True))
+    return res
+
+def allroots(m):
+    """The indexes of the root classes of a memo."""
+    if m.roots is not None:
+        return m.roots
+    return [m.root]
+
+def merge(dst, src, table):
+    """Copies the classes of the memo src into the memo dst.
+
+    The classes of dst are reused where possible, so that the queries
+    analyzed into the same memo share their common parts:
+
+    - the variables of the n-th scan of a table in src are those of
+      the n-th scan of that table in the queries merged before;
+    - the other classes are reused when their m-expressions and
+      properties are the same as those of a class of dst.
+
+    table is a dictionary from the key of each class of dst to its
+    index, which is updated with the classes copied. The result is the
+    index of the root of src in dst.
+
+    >>> from sqlio import Set
+    >>> dst, table = memo(), {}
+    >>> for lit in [1, 2]:
+    ...     src = memo()
+    ...     k = src.newcls(Exp('var', ['kv.k']), {'neededcols': Set([0])})
+    ...     s = src.newcls(Exp('scan', ['kv']), {'cols': [k], 'outs': Set([k]), 'labels': ['k'], 'neededcols': Set()})
+    ...     a = src.newcls(Exp('lit', [lit]), {'neededcols': Set()})
+    ...     c = src.newcls(Exp('>', [k, a]), {'neededcols': Set([k])})
+    ...     src.root = src.newcls(Exp('filter', [s, c]), {'cols': [k], 'outs': Set([k]), 'labels': ['k'], 'neededcols': Set()})
+    ...     merge(dst, src, table)
+    4
+    7
+    >>> dst[7]
+    <cls (filter 1 6)                             (:cols (0) :outs {0} :labels ("k") :neededcols {})>
+    """
+    from sqlio import Set
+    # Number the scans of each table. A scan that outputs the variables
+    # of another one in a different order is not a new scan.
+    occurrence, count = {}, {}
+    for c in src.classes:
+        e = c.mexprs[0]
+        if e.op == 'scan' and len(c.props.cols) > 0 and c.props.cols[0] not in occurrence:
+            n = count.get(e.args[0], 0)
+            count[e.args[0]] = n + 1
+            for v in c.props.cols:
+                occurrence[v] = n
+
+    # The classes only refer to classes before them, except for the
+    # variables, which are their own needed columns.
+    mapping = {}
+    for i, c in enumerate(src.classes):
+        if i in occurrence:
+            key = ('var', c.mexprs[0].args[0], occurrence[i])
+            if key in table:
+                mapping[i] = table[key]
+                continue
+            mapping[i] = len(dst.classes)
+        mexprs = [e if e.op in leafops or e.args is None else Exp(e.op, [mapping[a] for a in e.args])
+                  for e in c.mexprs]
+        props = Props()
+        for k, v in c.props.items():
+            if k == 'cols':
+                v = [mapping[j] for j in v]
+            elif k in ['outs', 'neededcols'] and v is not None:
+                v = Set(mapping[j] for j in v)
+            elif isinstance(v, list):
+                v = list(v)
+            props[k] = v
+        if i not in occurrence:
+            key = (tuple(dumps(e) if e.op in leafops or e.args is None else (e.op, tuple(e.args))
+                         for e in mexprs),
+                   tuple((k, frozenset(v) if isinstance(v, Set) else tuple(v) if isinstance(v, list) else v)
+                         for k, v in props.items()))
+            if key in table:
+                mapping[i] = table[key]
+                continue
+        j = dst.newcls(mexprs[0], props)
+        dst[j].mexprs = mexprs
+        table[key] = mapping[i] = j
+
+    for fp, i in src.shared.items():
+        dst.shared.setdefault(fp, mapping[i])
+    return mapping[src.root]
+
+def compact(m):
+    """Removes the classes of a memo that are not reachable from its roots.
+
+    The remaining classes are renumbered in the same order, and all the
+    m-expressions and column properties are updated accordingly.
+
+    The variables that are not used anywhere are also removed from the
+    columns of the relational classes, unless the columns are the result
+    of a query: the root classes, projections and scalar subqueries.
+
+    The result is a dict that maps the old index of each remaining
+    class to its new index, and the set of old indexes of the classes
+    whose columns were removed.
+
+    >>> from sqlio import Set
+    >>> m = memo()
+    >>> k = m.newcls(Exp('var', ['kv.k']), {'neededcols': Set([0])})
+    >>> v = m.newcls(Exp('var', ['kv.v']), {'neededcols': Set([1])})
+    >>> s = m.newcls(Exp('scan', ['kv']), {'cols': [k, v], 'outs': Set([k, v]), 'labels': ['k', 'v'], 'neededcols': Set()})
+    >>> dead = m.newcls(Exp('lit', [123]), {'neededcols': Set()})
+    >>> m.root = m.newcls(Exp('project', [s]), {'cols': [v], 'outs': Set([v]), 'labels': ['v'], 'neededcols': Set()})
+    >>> compact(m)
+    ({1: 0, 2: 1, 4: 2}, {2})
+    >>> print(m)
+    <memo
+    root: 2
+     0 <cls (var "kv.v")                             (:neededcols {0})>
+     1 <cls (scan "kv")                              (:cols (0) :outs {0} :labels ("v") :neededcols {})>
+     2 <cls (project 1)                              (:cols (0) :outs {0} :labels ("v") :neededcols {})>
+    >
+    """
+    from sqlio import Set
+    # Find the classes whose columns must be kept.
+    roots = allroots(m)
+    results = set(roots)
+    for i, c in enumerate(m.classes):
+        for e in c.mexprs:
+            if e.op == 'apply':
+                results.add(e.args[0])
+            elif e.op == 'shared':
+                # The columns correspond by position.
+                results.update([i, e.args[0]])
+    # Find the variables used by the reachable classes.
+    live = reachable(m, roots)
+    used = set()
+    for i in live:
+        c = m[i]
+        if c.props.cols is not None:
+            used.update(c.props.neededcols)
+            if i in results or c.mexprs[0].op == 'project':
+                used.update(c.props.cols)
+        for e in c.mexprs:
+            if c.props.cols is None and e.op not in leafops and e.args is not None:
+                used.update(e.args)
+    # Remove the other variables from the relational classes.
+    keep = {}
+    for i in live:
+        c = m[i]
+        if c.props.cols is None or i in results or c.mexprs[0].op == 'project':
+            continue
+        k = [j for j, col in enumerate(c.props.cols) if col in used or m[col].mexprs[0].op != 'var']
+        if len(k) < len(c.props.cols):
+            keep[i] = k
+    def cols(i):
+        if i in keep:
+            return [m[i].props.cols[j] for j in keep[i]]
+        return m[i].props.cols
+    live = reachable(m, roots, cols)
+
+    # Renumber.
+    order = sorted(live)
+    mapping = dict((o, n) for n, o in enumerate(order))
+    classes = []
+    for o in order:
+        c = m[o]
+        props = Props()
+        for k, v in c.props.items():
+            if k == 'cols':
+                v = [mapping[i] for i in cols(o)]
+            elif k == 'labels' and o in keep:
+                v = [v[j] for j in keep[o]]
+            elif k == 'outs' and o in keep:
+                v = Set(mapping[i] for i in cols(o))
+            elif k in ['outs', 'neededcols'] and v is not None:
+                v = Set(mapping[i] for i in v)
+            props[k] = v
+        n = cls(c.mexprs[0], props)
+        n.mexprs = [e if e.op in leafops or e.args is None else Exp(e.op, [mapping[a] for a in e.args])
+                    for e in c.mexprs]
+        classes.append(n)
+    m.classes = classes
+    if m.roots is not None:
+        m.roots = [mapping[r] for r in m.roots]
+    else:
+        m.root = mapping[m.root]
+    if mem.budget is not None:
+        m.size = sum(mem.classsize(c) for c in classes)
+    m.shared = dict((fp, mapping[i]) for fp, i in m.shared.items() if i in mapping and i not in keep)
+    return mapping, set(keep)
+
+def reachable(m, roots, cols=None):
+    """The set of indexes of the classes reachable from the given roots.
+
+    If cols is specified, it is used instead of the cols property to
+    find the columns of a relational class.
+    """
+    live, todo = set(), list(roots)
+    while len(todo) > 0:
+        i = todo.pop()
+        if i in live:
+            continue
+        live.add(i)
+        for e in m[i].mexprs:
+            if e.op not in leafops and e.args is not None:
+                todo.extend(e.args)
+        c = m[i].props.cols if cols is None else cols(i)
+        if c is not None:
+            todo.extend(c)
+    return live
+
+def conjuncts(m, idx):
+    """Splits a scalar class into the list of its AND-ed conditions.
+
+    >>> m = memo()
+    >>> a = m.newcls(Exp('lit', [1]), {})
+    >>> b = m.newcls(Exp('lit', [2]), {})
+    >>> c = m.newcls(Exp('and', [a, b]), {})
+    >>> conjuncts(m, m.newcls(Exp('and', [c, a]), {}))
+    [0, 1, 0]
+    """
+    e = m[idx].mexprs[0]
+    if e.op != 'and':
+        return [idx]
+    return [c for i in e.args for c in conjuncts(m, i)]
+
+def provided(m, idx):
+    """The variables provided by the scans of a relational expression.
+
+    The scalar expressions over the columns of a FROM subquery need the
+    variables of the scans below it, which are available in the source
+    as well as its output columns.
+
+    For example, the outer projection below is not correlated:
+
+    >>> from sql import analyze, loads
+    >>> m = analyze(loads('(select :exprs [(+ x 1)] :from (select :exprs [(:x (+ a 1))] :from ab))'))
+    >>> len(m[m.root].props.neededcols), list(provided(m, m[m.root].mexprs[0].args[0]))
+    (0, [0])
+    """
+    res, todo = Set(), [idx]
+    while len(todo) > 0:
+        i = todo.pop()
+        e = m[i].mexprs[0]
+        if e.op == 'scan':
+            res.update(m[i].props.outs)
+        elif e.op in ['filter', 'project']:
+            todo.append(e.args[0])
+        elif e.op in ['cross', 'lateral']:
+            todo.extend(e.args)
+    return res
+
+@prof.phase('render')
 def memo_as_string(m):
     """Render a memo as a string."""
     s = io.StringIO()
-    print("<memo\nroot:", m.root, file=s)
+    if m.roots is not None:
+        print("<memo\nroots:", *m.roots, file=s)
+    else:
+        print("<memo\nroot:", m.root, file=s)
     for i, c in enumerate(m.classes):
         print("%2d"%i, c, file=s)
     print(">", file=s, end='')
     return s.getvalue()
 
 import sys
-def print_tree(m):
+@prof.phase('render')
+def print_tree(m, annotate=None):
     """Show a memo as an expression tree.
 
     This displays SQL relational operators as a tree,
     and inlines scalar expressions together.
 
     The following operators are recognized as relational:
-    project, filter, scan, cross.
+    project, filter, scan, cross, lateral.
+
+    Alternative m-expressions, if any, are listed after the first one.
+
+    If annotate is specified, it is a function called with the index
+    of each relational class, which returns extra lines to display
+    for it.
 
     For example:
 
@@ -108,50 +508,86 @@ def print_tree(m):
                   :foo "bar"
              table kv
     <BLANKLINE>
+
+    The placeholders are shown with their number:
+
+    >>> p = m.newcls(Exp('param', [1]), {})
+    >>> m.root = m.newcls(Exp('filter', [s, m.newcls(Exp('=', [b, p]), {})]), {})
+    >>> print_tree(m)
+    ( 7) filter
+         props:
+         filter (= 456 (param 1))
+    <BLANKLINE>
+        ( 3) scan
+             props:
+                  :foo "bar"
+             table kv
+    <BLANKLINE>
     """
-    _printtree(0, m.root, m, sys.stdout)
+    if m.roots is None:
+        _printtree(0, m.root, m, sys.stdout, annotate, {})
+        return
+    # A batch of queries: the classes they share are shown for each of them.
+    cache = {}
+    for n, r in enumerate(m.roots):
+        print('query %d:' % (n+1))
+        _printtree(0, r, m, sys.stdout, annotate, cache)
 
-# Helper function for print_tree().
-def _printtree(indent, idx, m, buf):
+# Helper function for print_tree(). The rendering of the scalar
+# classes is kept in cache, by memo index.
+def _printtree(indent, idx, m, buf, annotate, cache):
     prefix = indent*' '
     e = m[idx].mexprs[0]
     rest = io.StringIO()
     print('%s(%2d) %s' % (prefix, idx, e.op), file=buf)
     print('%s     props:' % prefix, file=buf)
     for k, v in m[idx].props.items():
-        print('%s          :%s %s' % (prefix, k, sexpdata.dumps(v)), file=buf)
+        print('%s          :%s %s' % (prefix, k, dumps(v)), file=buf)
     if e.op == 'project':
-        print('%s     exprs' % prefix, ', '.join((_printscalar(indent, i, m, rest) for i in m[idx].props.cols)), file=buf)
+        print('%s     exprs' % prefix, ', '.join((_printscalar(indent, i, m, rest, annotate, cache) for i in m[idx].props.cols)), file=buf)
     elif e.op == 'filter':
-        print('%s     filter' % prefix, _printscalar(indent, e.args[1], m, rest), file=buf)
+        print('%s     filter' % prefix, _printscalar(indent, e.args[1], m, rest, annotate, cache), file=buf)
     elif e.op == 'scan':
-        print("%s     table" % prefix, e.args[0])
+        print("%s     table" % prefix, e.args[0], file=buf)
+    for alt in m[idx].mexprs[1:]:
+        print("%s     alt" % prefix, dumps(alt), file=buf)
+    if annotate is not None:
+        for l in annotate(idx):
+            print("%s     %s" % (prefix, l), file=buf)
     print(file=buf)
     if e.op in ['project', 'filter']:
-        _printtree(indent+4, e.args[0], m, buf)
-    elif e.op in ['cross']:
+        _printtree(indent+4, e.args[0], m, buf, annotate, cache)
+    elif e.op in ['cross', 'lateral']:
         for e in e.args:
-            _printtree(indent+4, e, m, buf)
+            _printtree(indent+4, e, m, buf, annotate, cache)
     rest = rest.getvalue()
     if len(rest) > 0:
         print('%s----' % prefix,file=buf)
         print(rest,file=buf)
 
 # Helper function for print_tree().
-def _printscalar(indent, i, m, buf):
-    def ps(exp):
-        if exp.op == 'lit':
-            return sexpdata.tosexp(exp.args[0])
-        elif exp.op == 'var':
-            return '(@%d %s)' % (i, exp.args[0])
-        elif exp.op in ['apply', 'exists']:
-            _printtree(indent, exp.args[0], m, buf)
-            return sexpdata.tosexp(exp)
-        else:
-            return '(%s %s)' % (exp.op,
-                                ' '.join(_printscalar(indent, i, m, buf) for i in exp.args))
-
-    return ps(m[i].mexprs[0])
+def _printscalar(indent, i, m, buf, annotate, cache):
+    s = cache.get(i, None)
+    if s is not None:
+        return s
+    exp = m[i].mexprs[0]
+    if exp.op == 'lit':
+        s = dumps(exp.args[0])
+    elif exp.op == 'param':
+        s = dumps(exp)
+    elif exp.op == 'var':
+        s = '(@%d %s)' % (i, exp.args[0])
+    elif exp.op in ['apply', 'exists']:
+        # The subquery is printed every time it is used: do not cache.
+        _printtree(indent, exp.args[0], m, buf, annotate, cache)
+        return dumps(exp)
+    else:
+        args = [_printscalar(indent, a, m, buf, annotate, cache) for a in exp.args]
+        s = '(%s %s)' % (exp.op, ' '.join(args))
+        if not all(a in cache for a in exp.args):
+            return s
+    cache[i] = s
+    return s
 
 if __name__ == "__main__":
     print("testing...")
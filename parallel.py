@@ -0,0 +1,146 @@
+"""
+Morsel-driven parallel execution of plans.
+
+The plan is split at its driving leaf: the scan (or index scan) found
+by following the first input of the relational operators from the
+root. The rows of that leaf are divided into morsels, ranges of
+consecutive positions, and a pool of worker processes executes the
+whole plan for one morsel at a time. The workers are forked, so they
+share the table data of the catalog with the parent process instead
+of receiving a copy of it.
+
+The results of the morsels are then merged by an exchange in the
+parent. Since the plans do not sort or aggregate, the exchange simply
+gathers the rows of the morsels, in the order of the morsels; the
+result is the same as with run.execute().
+
+Example:
+
+>>> import catalog
+>>> from sql import analyze, loads
+>>> catalog.tables['big'] = ('x',)
+>>> catalog.data['big'] = (list(range(100000)),)
+>>> m = analyze(loads('(select :exprs (* x 2) :from big :where (or (< x 50) (>= x 99950)))'))
+>>> res = execute(m, workers=4, morselsize=10000)
+>>> res[:3], res[-1], len(res)
+([(0,), (2,), (4,)], (199998,), 100)
+>>> res == run.execute(m)
+True
+
+The statistics collected by the workers (see run.opstats) are merged:
+each morsel counts as one loop.
+
+>>> stats = {}
+>>> res = execute(m, workers=4, morselsize=10000, stats=stats)
+>>> stats[m.root].rows, stats[m.root].loops
+(100, 10)
+
+The rows computed by the workers are sent back to the parent process
+through the pool, pickled.
+"""
+
+import multiprocessing
+import os
+
+import catalog
+import run
+
+# The default number of input rows processed at a time by a worker.
+morselsize = 100000
+
+def driver(m, idx, shared=()):
+    """Find the leaf that drives the execution of a relational class.
+
+    The result is the memo index of a scan or index scan class, or None
+    if the plan cannot be split into morsels. The classes whose results
+    are shared (see run.run_shared) must see all their rows, so the
+    driving leaf cannot be below them.
+    """
+    if idx in shared:
+        return None
+    e = m[idx].mexprs[run.choose(m, idx)]
+    if e.op in ['scan', 'indexscan']:
+        return idx
+    elif e.op in ['filter', 'project', 'cross', 'lateral']:
+        return driver(m, e.args[0], shared)
+    return None
+
+def inputsize(m, idx):
+    """The number of input positions of a scan or index scan class."""
+    e = m[idx].mexprs[run.choose(m, idx)]
+    if e.op == 'scan':
+        return len(catalog.data[e.args[0]][0])
+    r = e.args
+    return len(catalog.get_index(r.table, r.col).lookup(r.lo, r.hi, r.bounds))
+
+# _plan is the memo being executed by the workers, the values of its
+# placeholders, and whether to collect statistics. It is set before the
+# workers are forked, so that they inherit it.
+_plan = None
+
+def run_morsel(morsel):
+    """Execute the plan over one morsel, in a worker.
+
+    The result is the rows, and the statistics if requested.
+    """
+    m, params, collect = _plan
+    stats = {} if collect else None
+    return run.rows(run.context(m, stats, morsel=morsel, params=params)), stats
+
+def exchange(results, stats=None):
+    """Merge the results of the morsels, and their statistics into stats."""
+    res = []
+    for r, s in results:
+        res.extend(r)
+        if stats is not None:
+            mergestats(stats, s)
+    return res
+
+def mergestats(stats, more):
+    """Add the statistics of one morsel to those of the other morsels."""
+    for idx, s in more.items():
+        t = stats.get(idx, None)
+        if t is None:
+            stats[idx] = s
+            continue
+        t.loops += s.loops
+        t.reused += s.reused
+        t.rows += s.rows
+        t.batches += s.batches
+        t.time += s.time
+        t.mem = max(t.mem, s.mem)
+        t.bloomed += s.bloomed
+
+def execute(m, workers=None, morselsize=morselsize, params=(), stats=None):
+    """Execute the plan in memo m in parallel, and return the result rows.
+
+    The number of workers defaults to the number of processors. Plans
+    that do not have a driving leaf, or whose input fits in a single
+    morsel, are executed in the current process.
+
+    If stats is specified, it is populated like with run.execute().
+    """
+    global _plan
+    d = driver(m, m.root, run.context(m).shared)
+    if d is None or 'fork' not in multiprocessing.get_all_start_methods():
+        return run.execute(m, stats, params=params)
+    n = inputsize(m, d)
+    if n <= morselsize:
+        return run.execute(m, stats, params=params)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    morsels = [(d, lo, lo + morselsize) for lo in range(0, n, morselsize)]
+    _plan = (m, params, stats is not None)
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(min(workers, len(morsels))) as pool:
+            return exchange(pool.imap(run_morsel, morsels), stats)
+    finally:
+        _plan = None
+
+if __name__ == "__main__":
+    print("testing...")
+    import doctest
+    doctest.testmod()
+    print("testing done")
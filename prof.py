@@ -0,0 +1,151 @@
+import contextlib
+import functools
+import time
+
+# The profile being collected, if profiling is enabled.
+_current = None
+
+class profile(object):
+    """An object that collects the timers and counters for one query.
+
+    - timers: the total time spent in each phase, in seconds.
+    - calls: the number of calls to each phase.
+    - counters: the value of each counter.
+
+    Timers are exclusive of the time spent in nested phases, so
+    the timers of a query add up to its total profiled time.
+    """
+    def __init__(self):
+        self.timers = {}
+        self.calls = {}
+        self.counters = {}
+        # The stack of phases being timed; each entry is
+        # [phase name, start time, time spent in nested phases].
+        self._stack = []
+
+    def asdict(self):
+        return {'timers': self.timers, 'calls': self.calls, 'counters': self.counters}
+
+    def __repr__(self):
+        return '<profile %r>' % self.asdict()
+
+def phase(name):
+    """This decorator times the calls to a function as a profiling phase.
+
+    The timing is only active while a profile is being collected, see
+    profiling() below.
+
+    >>> @phase('double')
+    ... def double(x):
+    ...     count('doubled')
+    ...     return x * 2
+    >>> sink = memsink()
+    >>> with profiling(sink):
+    ...     double(double(3))
+    12
+    >>> p = sink.profiles[0]
+    >>> p.calls, p.counters
+    ({'double': 2}, {'doubled': 2})
+    >>> p.timers['double'] > 0
+    True
+    """
+    def wrap(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            p = _current
+            if p is None:
+                return func(*args, **kwargs)
+
+            p.calls[name] = p.calls.get(name, 0) + 1
+            entry = [name, time.perf_counter(), 0.0]
+            p._stack.append(entry)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                p._stack.pop()
+                elapsed = time.perf_counter() - entry[1]
+                p.timers[name] = p.timers.get(name, 0.0) + elapsed - entry[2]
+                if len(p._stack) > 0:
+                    p._stack[-1][2] += elapsed
+        return timed_func
+    return wrap
+
+def count(name, n=1):
+    """Increment a counter in the current profile, if any."""
+    p = _current
+    if p is not None:
+        p.counters[name] = p.counters.get(name, 0) + n
+
+def observe(name, v):
+    """Record the maximum of the observed values as a counter.
+
+    >>> sink = memsink()
+    >>> with profiling(sink):
+    ...     observe('depth', 3)
+    ...     observe('depth', 1)
+    >>> sink.profiles[0].counters
+    {'depth': 3}
+    """
+    p = _current
+    if p is not None and v > p.counters.get(name, v-1):
+        p.counters[name] = v
+
+@contextlib.contextmanager
+def profiling(sink):
+    """Collect a profile for the duration of the context.
+
+    The profile is sent to the sink at the end, even if an exception
+    was raised.
+    """
+    global _current
+    prev = _current
+    p = profile()
+    _current = p
+    try:
+        yield p
+    finally:
+        _current = prev
+        sink.emit(p)
+
+class memsink(object):
+    """A sink that keeps the profiles in memory."""
+    def __init__(self):
+        self.profiles = []
+
+    def emit(self, p):
+        self.profiles.append(p)
+
+class jsonsink(object):
+    """A sink that appends the profiles to a file, one JSON object per line."""
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, p):
+        import json
+        with open(self.path, 'a') as f:
+            print(json.dumps(p.asdict(), sort_keys=True), file=f)
+
+class printsink(object):
+    """A sink that prints the profiles to the screen.
+
+    >>> p = profile()
+    >>> p.timers['parse'] = 0.0012
+    >>> p.calls['parse'] = 1
+    >>> p.counters['classes.scan'] = 2
+    >>> printsink().emit(p)
+    profile:
+      parse                 1.200 ms   1 calls
+      classes.scan         2
+    """
+    def emit(self, p):
+        print("profile:")
+        for k in sorted(p.timers):
+            print("  %-20s %6.3f ms %3d calls" % (k, p.timers[k]*1000, p.calls[k]))
+        for k in sorted(p.counters):
+            print("  %-20s %d" % (k, p.counters[k]))
+
+if __name__ == "__main__":
+    import doctest
+    print("testing...")
+    doctest.testmod()
+    print("testing done")
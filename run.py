@@ -0,0 +1,731 @@
+"""
+The code here executes the plans built by the analyzer in sql.py,
+over the table data in the catalog.
+
+Each relational class is executed as a stream of batches of rows. A
+batch stores its rows column-wise: each column is identified by the
+memo index of the scalar class that computes it.
+
+A filter over a cross join is executed as a hash join when its
+condition compares the inputs for equality; see run_join() below.
+
+Correlated subqueries are executed once per row of the enclosing
+query. The row is passed down as an "outer" batch, which the leaves of
+the subquery (scans, unary) combine with their own rows; this way all
+the columns needed by the subquery are available in its batches.
+
+Example:
+
+>>> from sql import analyze, loads
+>>> m = analyze(loads('(select :exprs [k (+ v 1)] :from kv :where (> k 3))'))
+>>> execute(m)
+[(4, 31), (5, 41)]
+"""
+
+import operator
+import sys
+import time
+
+import catalog
+from bloom import bloom
+from memo import allroots, conjuncts, leafops, provided, reachable, refs
+
+# The maximum number of rows in a batch produced by a scan.
+batchsize = 1024
+
+class batch(object):
+    """An object that represents a set of rows stored column-wise.
+
+    - n: the number of rows.
+    - cols: a dictionary from memo index to the list of values
+      in that column.
+
+    >>> b = batch(2, {0: [1, 2], 1: ['a', 'b']})
+    >>> b
+    <batch 2 {0: [1, 2], 1: ['a', 'b']}>
+    >>> b.row(1)
+    <batch 1 {0: [2], 1: ['b']}>
+    """
+    def __init__(self, n, cols):
+        self.n = n
+        self.cols = cols
+
+    def row(self, i):
+        """Extract a single row as a batch."""
+        return batch(1, dict((k, [v[i]]) for k, v in self.cols.items()))
+
+    def select(self, keep):
+        """Keep only the rows whose position is listed in keep."""
+        return batch(len(keep), dict((k, [v[i] for i in keep]) for k, v in self.cols.items()))
+
+    def __repr__(self):
+        return '<batch %d %r>' % (self.n, self.cols)
+
+def crossbatch(a, b):
+    """Combine every row of batch a with every row of batch b.
+
+    >>> crossbatch(batch(2, {0: [1, 2]}), batch(2, {1: [3, 4]}))
+    <batch 4 {0: [1, 1, 2, 2], 1: [3, 4, 3, 4]}>
+    """
+    cols = {}
+    for k, v in a.cols.items():
+        cols[k] = [x for x in v for _ in range(b.n)]
+    for k, v in b.cols.items():
+        cols[k] = v * a.n
+    return batch(a.n * b.n, cols)
+
+class context(object):
+    """An object that holds the state of one execution.
+
+    - memo: the memo that holds the plan.
+    - stats: if not None, a dictionary from memo index to the
+      statistics collected for each relational class (see opstats).
+    - morsel: if not None, a tuple (idx, lo, hi) that restricts the
+      scan or index scan class idx to the rows at positions lo to hi
+      in its input (see parallel.py).
+    - blooms: a dictionary from the memo index of a scan or index scan
+      class to the Bloom filters pushed down into it, as a list of
+      (key column indexes, bloom) pairs.
+    - params: the values of the placeholders (param 1), (param 2) etc.
+    - shared: the set of the memo indexes of the classes whose results
+      are shared with other classes (see shared()).
+    - results: a dictionary from the memo index of a shared class to
+      the batch with all its rows, once computed.
+    - values: a dictionary from (op, memo index) to the value of an
+      uncorrelated subquery, once computed.
+    """
+    def __init__(self, memo, stats=None, morsel=None, params=()):
+        self.memo = memo
+        self.stats = stats
+        self.morsel = morsel
+        self.blooms = {}
+        self.params = params
+        self.shared = shared(memo)
+        self.results = {}
+        self.values = {}
+
+def shared(m):
+    """The relational classes whose results are used by several classes.
+
+    These are the classes computed by identical subqueries (see
+    run_shared), and those used by several other classes, e.g. both as
+    a FROM source and as a scalar subquery:
+
+    >>> from sql import analyze, loads
+    >>> m = analyze(loads('(select :exprs [x a (select :exprs [(:x k)] :from kv)] :from [(select :exprs [(:x k)] :from kv) ab] :where (= x (+ a 1)))'))
+    >>> sorted(shared(m))
+    [2]
+    >>> execute(m)
+    [(2, 1, 1), (3, 2, 1), (4, 3, 1)]
+    """
+    res, users = set(), {}
+    for i in reachable(m, allroots(m)):
+        for e in m[i].mexprs:
+            if e.op == 'shared':
+                res.add(e.args[0])
+            elif e.op not in leafops and e.args is not None:
+                for a in e.args:
+                    users.setdefault(a, set()).add(i)
+    res.update(a for a, u in users.items() if len(u) > 1 and m[a].props.outs is not None)
+    return res
+
+class opstats(object):
+    """The statistics collected while executing one relational class.
+
+    - loops: the number of times the class was executed.
+    - reused: the number of times the materialized results of a shared
+      class were produced again instead (see materialized()).
+    - rows, batches: the number of rows and batches produced.
+    - time: the wall time spent producing them, in seconds,
+      including the time spent in the inputs.
+    - mem: the size in bytes of the largest batch produced.
+    - alt: the position of the m-expression that was executed.
+    - method: how the m-expression was executed, if not directly.
+    - bloomed: the number of rows dropped by pushed down Bloom filters.
+    """
+    def __init__(self):
+        self.loops = 0
+        self.reused = 0
+        self.rows = 0
+        self.batches = 0
+        self.time = 0.0
+        self.mem = 0
+        self.alt = 0
+        self.method = None
+        self.bloomed = 0
+
+def execute(m, stats=None, params=()):
+    """Execute the plan in memo m, and return the result rows.
+
+    If stats is specified, it must be a dictionary, which is populated
+    with the statistics of each relational class that was executed.
+
+    params holds the values of the placeholders:
+
+    >>> from sql import analyze, loads
+    >>> execute(analyze(loads('(select :exprs k :from kv :where (= v (param 1)))')), params=(30,))
+    [(4,)]
+    """
+    return rows(context(m, stats, params=params))
+
+def execute_batch(m, stats=None, params=()):
+    """Execute the plans of a batch of queries analyzed into memo m.
+
+    The result is the list of the result rows of each query. The
+    relational classes used by several queries are executed only once,
+    and their results are kept for the other queries (see common()):
+
+    >>> from sql import analyze_batch, loads
+    >>> m = analyze_batch([loads('(select :exprs k :from kv :where (> k 2))'),
+    ...                    loads('(select :exprs (* v 2) :from kv :where (> k 2))')])
+    >>> stats = {}
+    >>> execute_batch(m, stats)
+    [[(3,), (4,), (5,)], [(40,), (60,), (80,)]]
+    >>> stats[5].loops, stats[5].reused, stats[5].rows, stats[2].loops
+    (1, 1, 3, 1)
+    """
+    ctx = context(m, stats, params=params)
+    ctx.shared.update(common(m))
+    return [rows(ctx, r) for r in m.roots]
+
+def common(m):
+    """The relational classes used by more than one query of a batch.
+
+    Only the topmost ones are returned: the classes below them are only
+    executed once anyway.
+    """
+    res, owner = set(), {}
+    for n, r in enumerate(m.roots):
+        todo = [r]
+        while len(todo) > 0:
+            i = todo.pop()
+            if i in owner:
+                if owner[i] != n and m[i].props.outs is not None and len(m[i].props.neededcols) == 0:
+                    res.add(i)
+                continue
+            owner[i] = n
+            todo.extend(refs(m, i, True))
+    return res
+
+def rows(ctx, root=None):
+    """Execute the plan in the context's memo, and return the result rows.
+
+    The plan starts at the memo's root, unless another root is given.
+    """
+    if root is None:
+        root = ctx.memo.root
+    cols = ctx.memo[root].props.cols
+    res = []
+    for b in run(ctx, root, None):
+        res.extend(zip(*[b.cols[c] for c in cols]) if len(cols) > 0 else [()] * b.n)
+    return res
+
+def choose(m, idx):
+    """Select which m-expression to use to execute a class.
+
+    The exploration only adds alternatives that are expected to be
+    cheaper than the original m-expression, so we use the last one.
+    """
+    return len(m[idx].mexprs) - 1
+
+def run(ctx, idx, outer):
+    """Execute a relational class, and return an iterator over its batches.
+
+    If outer is not None, it is a batch with the row of the enclosing
+    query for a correlated subquery.
+    """
+    alt = choose(ctx.memo, idx)
+    e = ctx.memo[idx].mexprs[alt]
+    f = relops.get(e.op, None)
+    if f is None:
+        raise Exception("unknown relational operator: %s" % e.op)
+    if outer is None and idx in ctx.shared:
+        return materialized(ctx, idx, alt, f, e)
+    it = f(ctx, idx, e, outer)
+    if ctx.stats is None:
+        return it
+    return instrument(ctx, idx, alt, it)
+
+def materialized(ctx, idx, alt, f, e):
+    """Produce the rows of a shared class, computing them only once.
+
+    Only the computation is instrumented; the other uses of the results
+    are counted as reused.
+    """
+    b = ctx.results.get(idx, None)
+    if b is None:
+        it = f(ctx, idx, e, None)
+        if ctx.stats is not None:
+            it = instrument(ctx, idx, alt, it)
+        b = ctx.results[idx] = concat(list(it))
+    elif ctx.stats is not None:
+        ctx.stats[idx].reused += 1
+    if b.n > 0:
+        yield b
+
+def instrument(ctx, idx, alt, it):
+    """Collect statistics about the batches produced by an iterator."""
+    s = ctx.stats.get(idx, None)
+    if s is None:
+        s = ctx.stats[idx] = opstats()
+    s.loops += 1
+    s.alt = alt
+    while True:
+        start = time.perf_counter()
+        try:
+            b = next(it)
+        except StopIteration:
+            s.time += time.perf_counter() - start
+            return
+        s.time += time.perf_counter() - start
+        s.rows += b.n
+        s.batches += 1
+        s.mem = max(s.mem, batchmem(b))
+        yield b
+
+def batchmem(b):
+    """Estimate the size in bytes of a batch."""
+    return sum(sys.getsizeof(v) for v in b.cols.values())
+
+def withouter(b, outer):
+    """Combine the rows of a leaf operator with the enclosing row, if any."""
+    if outer is None:
+        return b
+    return crossbatch(outer, b)
+
+def colnames(m, idx):
+    """The table column names for the variables output by a scan class."""
+    return [m[v].mexprs[0].args[0].split('.', 1)[1] for v in m[idx].props.cols]
+
+def morsel(ctx, idx, n):
+    """The range of input positions to process in a scan class."""
+    if ctx.morsel is not None and ctx.morsel[0] == idx:
+        return ctx.morsel[1], min(n, ctx.morsel[2])
+    return 0, n
+
+def run_scan(ctx, idx, e, outer):
+    m = ctx.memo
+    tn = e.args[0]
+    schema = catalog.tables[tn]
+    data = [catalog.data[tn][schema.index(c)] for c in colnames(m, idx)]
+    vars = m[idx].props.cols
+    start, end = morsel(ctx, idx, len(catalog.data[tn][0]) if len(schema) > 0 else 0)
+    for lo in range(start, end, batchsize):
+        hi = min(end, lo + batchsize)
+        b = probebloom(ctx, idx, batch(hi - lo, dict((v, d[lo:hi]) for v, d in zip(vars, data))))
+        if b.n > 0:
+            yield withouter(b, outer)
+
+def run_indexscan(ctx, idx, e, outer):
+    m = ctx.memo
+    r = e.args
+    tn = r.table
+    schema = catalog.tables[tn]
+    data = [catalog.data[tn][schema.index(c)] for c in colnames(m, idx)]
+    vars = m[idx].props.cols
+    rowids = catalog.get_index(tn, r.col).lookup(r.lo, r.hi, r.bounds)
+    start, end = morsel(ctx, idx, len(rowids))
+    for lo in range(start, end, batchsize):
+        ids = rowids[lo:min(end, lo + batchsize)]
+        b = probebloom(ctx, idx, batch(len(ids), dict((v, [d[i] for i in ids]) for v, d in zip(vars, data))))
+        if b.n > 0:
+            yield withouter(b, outer)
+
+def probebloom(ctx, idx, b):
+    """Drop the rows of a scan batch that fail the Bloom filters pushed into it."""
+    for keys, bf in ctx.blooms.get(idx, ()):
+        keep = [i for i, k in enumerate(zip(*[evaluate(ctx, c, b) for c in keys])) if k in bf]
+        if ctx.stats is not None:
+            ctx.stats[idx].bloomed += b.n - len(keep)
+        if len(keep) < b.n:
+            b = b.select(keep)
+    return b
+
+def run_unary(ctx, idx, e, outer):
+    yield withouter(batch(1, {}), outer)
+
+def run_filter(ctx, idx, e, outer):
+    m = ctx.memo
+    if outer is None and m[e.args[0]].mexprs[choose(m, e.args[0])].op == 'cross':
+        return run_join(ctx, idx, e)
+    return filtered(ctx, run(ctx, e.args[0], outer), [e.args[1]])
+
+def filtered(ctx, batches, conds):
+    """Keep the rows of the batches for which all the conditions are true."""
+    for b in batches:
+        b = applyconds(ctx, b, conds)
+        if b.n > 0:
+            yield b
+
+def applyconds(ctx, b, conds):
+    """Keep the rows of a batch for which all the conditions are true."""
+    for c in conds:
+        vals = evaluate(ctx, c, b)
+        keep = [i for i, v in enumerate(vals) if v is True]
+        if len(keep) < b.n:
+            b = b.select(keep)
+    return b
+
+def run_join(ctx, idx, e):
+    """Execute a filter over a cross join as a hash join.
+
+    The first input of the cross join is the probe side; the other
+    inputs are build sides. Each build side is read entirely, keeping
+    only the rows that pass the conditions that depend only on it. If
+    some conditions compare it with the probe side for equality, the
+    rows are stored in a hash table on the compared values, and a Bloom
+    filter over these values is pushed down into the scan of the probe
+    side, so that the probe rows that cannot match are dropped before
+    they enter the pipeline. The build sides with no such condition are
+    cross joined.
+
+    >>> from sql import analyze, loads
+    >>> m = analyze(loads('(select :exprs [k a] :from [kv ab] :where (and (= v b) (> a 1)))'))
+    >>> stats = {}
+    >>> execute(m, stats)
+    [(2, 2), (3, 2), (4, 3)]
+
+    The columns computed by a FROM subquery can be compared too, and the
+    Bloom filter is evaluated by the scan below it:
+
+    >>> m = analyze(loads('(select :exprs [j a] :from [(select :exprs [(:j (+ k 1))] :from kv) ab] :where (= j a))'))
+    >>> stats = {}
+    >>> execute(m, stats)
+    [(2, 2), (3, 3)]
+    >>> [s.bloomed for s in stats.values() if s.bloomed > 0]
+    [3]
+
+    When no row of a build side passes its conditions, the result is
+    empty:
+
+    >>> execute(analyze(loads('(select :exprs [k a] :from [kv ab] :where (and (= k a) (> b 100)))')))
+    []
+    """
+    m = ctx.memo
+    if ctx.stats is not None:
+        ctx.stats[idx].method = 'hash join'
+    inputs = m[e.args[0]].mexprs[choose(m, e.args[0])].args
+    # The conditions are sorted by the variables provided by the inputs
+    # (see provided), so that the columns computed by a FROM subquery
+    # are attributed to it.
+    outs = [provided(m, i) for i in inputs]
+
+    # Sort the conditions: those that depend on a single input, the
+    # equalities between the probe side and a build side, and the rest.
+    local = [[] for _ in inputs]
+    keys = [([], []) for _ in inputs]
+    rest = []
+    for c in conjuncts(m, e.args[1]):
+        home = [i for i, o in enumerate(outs) if dependson(m, c, o)]
+        if len(home) > 0:
+            local[home[0]].append(c)
+            continue
+        ce = m[c].mexprs[0]
+        if ce.op == '=':
+            l, r = ce.args
+            builds = [i for i in range(1, len(inputs)) if dependson(m, r, outs[i])]
+            if len(builds) == 0 or not dependson(m, l, outs[0]):
+                l, r = r, l
+                builds = [i for i in range(1, len(inputs)) if dependson(m, r, outs[i])]
+            if len(builds) > 0 and dependson(m, l, outs[0]):
+                keys[builds[0]][0].append(l)
+                keys[builds[0]][1].append(r)
+                continue
+        rest.append(c)
+
+    # Read the build sides.
+    leaf = probeleaf(m, inputs[0], ctx.shared)
+    builds = []
+    for i in range(1, len(inputs)):
+        b = concat(list(filtered(ctx, run(ctx, inputs[i], None), local[i])))
+        if b.n == 0:
+            # Nothing to join with.
+            return
+        pkeys, bkeys = keys[i]
+        if len(pkeys) == 0:
+            builds.append((None, None, b))
+            continue
+        table, bf = {}, bloom(b.n)
+        for pos, k in enumerate(zip(*[evaluate(ctx, c, b) for c in bkeys])):
+            if None in k:
+                # NULL never compares equal.
+                continue
+            table.setdefault(k, []).append(pos)
+            bf.add(k)
+        if leaf is not None and all(dependson(m, c, m[leaf].props.outs) for c in pkeys):
+            ctx.blooms.setdefault(leaf, []).append((pkeys, bf))
+        builds.append((pkeys, table, b))
+
+    # Probe.
+    for b in filtered(ctx, run(ctx, inputs[0], None), local[0]):
+        for pkeys, table, bb in builds:
+            if table is None:
+                b = crossbatch(b, bb)
+            else:
+                b = probe(ctx, b, pkeys, table, bb)
+            if b.n == 0:
+                break
+        b = applyconds(ctx, b, rest)
+        if b.n > 0:
+            yield b
+
+def dependson(m, idx, outs):
+    """Whether a scalar class only depends on (and depends on some of) the given columns."""
+    need = m[idx].props.neededcols
+    return len(need) > 0 and all(c in outs for c in need)
+
+def probeleaf(m, idx, shared=()):
+    """Find the scan or index scan below filters and projections, if any.
+
+    The classes whose results are shared (see run_shared) must see all
+    their rows, so the scan cannot be below them.
+    """
+    if idx in shared:
+        return None
+    e = m[idx].mexprs[choose(m, idx)]
+    if e.op in ['scan', 'indexscan']:
+        return idx
+    elif e.op in ['filter', 'project']:
+        return probeleaf(m, e.args[0], shared)
+    return None
+
+def probe(ctx, b, pkeys, table, bb):
+    """Join the rows of batch b with the matching rows of a build side."""
+    left, right = [], []
+    for pos, k in enumerate(zip(*[evaluate(ctx, c, b) for c in pkeys])):
+        for bpos in table.get(k, ()):
+            left.append(pos)
+            right.append(bpos)
+    res = b.select(left)
+    res.cols.update(bb.select(right).cols)
+    res.n = len(left)
+    return res
+
+def run_project(ctx, idx, e, outer):
+    cols = ctx.memo[idx].props.cols
+    for b in run(ctx, e.args[0], outer):
+        res = dict((c, evaluate(ctx, c, b)) for c in cols)
+        if outer is not None:
+            # Keep the columns of the enclosing row available.
+            for c in outer.cols:
+                res.setdefault(c, b.cols[c])
+        yield batch(b.n, res)
+
+def run_cross(ctx, idx, e, outer):
+    # The outer row, if any, only needs to be combined once. It is
+    # passed to the first input, and to the other inputs only if they
+    # need it.
+    rest = []
+    for i in e.args[1:]:
+        o = outer if len(ctx.memo[i].props.neededcols) > 0 else None
+        rest.append(concat(list(run(ctx, i, o))))
+    for b in run(ctx, e.args[0], outer):
+        for r in rest:
+            b = crossbatch(b, r)
+        if b.n > 0:
+            yield b
+
+def run_lateral(ctx, idx, e, outer):
+    """Execute a lateral join.
+
+    The right input is executed once per batch of the left input, with
+    that batch as outer batch: its leaves combine their rows with all
+    the rows of the left batch at once, instead of once per row. The
+    positions of the left rows are passed along, so that the results
+    can be put back in the order of the left rows.
+
+    >>> from sql import analyze, loads
+    >>> m = analyze(loads('(select :exprs [k a] :from [kv (lateral (select :exprs a :from ab :where (< a k)))])'))
+    >>> execute(m)
+    [(2, 1), (3, 1), (3, 2), (4, 1), (4, 2), (4, 3), (5, 1), (5, 2), (5, 3)]
+    """
+    left, right = e.args
+    pos = ('rowid', idx)
+    for b in run(ctx, left, outer):
+        lb = batch(b.n, dict(b.cols))
+        lb.cols[pos] = list(range(b.n))
+        res = concat(list(run(ctx, right, lb)))
+        if res.n == 0:
+            continue
+        rowids = res.cols.pop(pos)
+        yield res.select(sorted(range(res.n), key=rowids.__getitem__))
+
+def run_shared(ctx, idx, e, outer):
+    """Produce the rows of another class, computed by an identical subquery.
+
+    The columns of both classes correspond by position.
+
+    >>> from sql import analyze, loads
+    >>> m = analyze(loads('(select :exprs [x y] :from [(select :exprs [(:x a)] :from ab :where (> b 10)) (select :exprs [(:y a)] :from ab :where (> b 10))])'))
+    >>> m[13].mexprs[1]
+    Exp('shared', [6])
+    >>> stats = {}
+    >>> execute(m, stats)
+    [(2, 2), (2, 3), (3, 2), (3, 3)]
+    >>> stats[6].loops, stats[6].reused, stats[5].loops, 12 in stats
+    (1, 1, 1, False)
+    """
+    m = ctx.memo
+    src = e.args[0]
+    for b in run(ctx, src, None):
+        cols = dict((c, b.cols[s]) for c, s in zip(m[idx].props.cols, m[src].props.cols))
+        yield withouter(batch(b.n, cols), outer)
+
+def concat(batches):
+    """Concatenate a list of batches into a single batch."""
+    if len(batches) == 0:
+        return batch(0, {})
+    cols = dict((k, []) for k in batches[0].cols)
+    for b in batches:
+        for k, v in b.cols.items():
+            cols[k].extend(v)
+    return batch(sum(b.n for b in batches), cols)
+
+relops = {
+    'scan': run_scan,
+    'indexscan': run_indexscan,
+    'unary': run_unary,
+    'filter': run_filter,
+    'project': run_project,
+    'cross': run_cross,
+    'lateral': run_lateral,
+    'shared': run_shared,
+}
+
+def nullable(f):
+    """Make a scalar function return None if any argument is None."""
+    def g(*args):
+        if None in args:
+            return None
+        return f(*args)
+    return g
+
+def sqland(*args):
+    if False in args:
+        return False
+    if None in args:
+        return None
+    return True
+
+def sqlor(*args):
+    if True in args:
+        return True
+    if None in args:
+        return None
+    return False
+
+scalarops = {
+    '+': nullable(operator.add),
+    '-': nullable(operator.sub),
+    '*': nullable(operator.mul),
+    '/': nullable(operator.truediv),
+    '=': nullable(operator.eq),
+    '!=': nullable(operator.ne),
+    '<': nullable(operator.lt),
+    '<=': nullable(operator.le),
+    '>': nullable(operator.gt),
+    '>=': nullable(operator.ge),
+    'not': nullable(operator.not_),
+    'and': sqland,
+    'or': sqlor,
+}
+
+def evaluate(ctx, idx, b):
+    """Evaluate a scalar class over a batch, and return the list of values."""
+    e = ctx.memo[idx].mexprs[0]
+    if e.op == 'var' or idx in b.cols:
+        return b.cols[idx]
+    elif e.op == 'lit':
+        return [e.args[0]] * b.n
+    elif e.op == 'param':
+        n = e.args[0]
+        if n < 1 or n > len(ctx.params):
+            raise Exception("no value for placeholder: %d" % n)
+        return [ctx.params[n-1]] * b.n
+    elif e.op in ['apply', 'exists']:
+        return evaluate_subquery(ctx, idx, e, b)
+    f = scalarops.get(e.op, None)
+    if f is None:
+        raise Exception("unknown scalar operator: %s" % e.op)
+    return [f(*vals) for vals in zip(*[evaluate(ctx, i, b) for i in e.args])]
+
+def evaluate_subquery(ctx, idx, e, b):
+    """Evaluate a scalar subquery (apply) or EXISTS over a batch.
+
+    A subquery is correlated if any of its clauses uses the enclosing
+    row, including its projections:
+
+    >>> from sql import analyze, loads
+    >>> execute(analyze(loads('(select :exprs [k (select :exprs (+ a k) :from ab :where (= a 1))] :from kv)')))
+    [(1, 2), (2, 3), (3, 4), (4, 5), (5, 6)]
+    >>> execute(analyze(loads('(select :exprs [k (select :exprs v :from ab :where (= a 1))] :from kv)')))
+    [(1, 10), (2, 20), (3, 20), (4, 30), (5, 40)]
+    """
+    r = e.args[0]
+    if len(ctx.memo[r].props.neededcols) == 0:
+        # Not correlated: the result is the same for all rows, and
+        # for all the batches.
+        key = (e.op, r)
+        if key not in ctx.values:
+            ctx.values[key] = subquery_value(ctx, e, r, None)
+        return [ctx.values[key]] * b.n
+    return [subquery_value(ctx, e, r, b.row(i)) for i in range(b.n)]
+
+def subquery_value(ctx, e, r, outer):
+    col = ctx.memo[r].props.cols[0] if e.op == 'apply' else None
+    for sb in run(ctx, r, outer):
+        if sb.n > 0:
+            return True if col is None else sb.cols[col][0]
+    return False if col is None else None
+
+def estimate(m, idx):
+    """Estimate the number of rows produced by a relational class.
+
+    The result is None when no estimate is available.
+    """
+    e = m[idx].mexprs[0]
+    if e.op == 'scan':
+        return len(catalog.data[e.args[0]][0])
+    elif e.op == 'unary':
+        return 1
+    elif e.op == 'project':
+        return estimate(m, e.args[0])
+    elif e.op == 'cross':
+        n = 1
+        for i in e.args:
+            c = estimate(m, i)
+            if c is None:
+                return None
+            n *= c
+        return n
+    return None
+
+def annotate(m, stats):
+    """Return a function that describes the execution statistics of a class.
+
+    This is suitable for the annotate argument of memo.print_tree().
+    """
+    def describe(idx):
+        est = estimate(m, idx)
+        est = '' if est is None else ' (estimated rows=%d)' % est
+        s = stats.get(idx, None)
+        if s is None:
+            return ['actual never executed' + est]
+        lines = ['actual rows=%d batches=%d loops=%d time=%.3fms mem=%dB%s' %
+                 (s.rows, s.batches, s.loops, s.time * 1000, s.mem, est)]
+        if s.reused > 0:
+            lines.append('results reused=%d' % s.reused)
+        if s.alt > 0:
+            lines.append('using alt %d' % s.alt)
+        if s.method is not None:
+            lines.append('using %s' % s.method)
+        if s.bloomed > 0:
+            lines.append('rows removed by bloom filter=%d' % s.bloomed)
+        return lines
+    return describe
+
+if __name__ == "__main__":
+    print("testing...")
+    import doctest
+    doctest.testmod()
+    print("testing done")
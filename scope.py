@@ -1,4 +1,5 @@
 from show import show
+import prof
 
 class scope(object):
     """An object to represent a naming scope.
@@ -24,6 +25,13 @@ class scope(object):
     1
     >>> print(lookup(s, 'kv.v'))
     None
+
+    The names without table (e.g. the columns of a subquery) do not
+    hide the columns of the tables:
+
+    >>> s2.bind('', 'x', 3)
+    >>> lookup(s2, 'x'), lookup(s2, 'v')
+    (3, 42)
     """
 
     def __init__(self, parent):
@@ -36,9 +44,10 @@ class scope(object):
         d[colname] = idx
         self.scope[tn] = d
 
-    def _lookup(self, tn, colname):
+    def _lookup(self, tn, colname, depth=0):
         """recursive function to implement lookup()"""
-        if tn in self.scope:
+        prof.observe('scope.max_lookup_depth', depth)
+        if tn in self.scope and (tn != '' or colname in self.scope[tn]):
             return self.scope[tn].get(colname, None)
         elif tn == '':
             for cols in self.scope.values():
@@ -48,7 +57,8 @@ class scope(object):
             # too.
         if self.parent is None:
             return None
-        return self.parent._lookup(tn, colname)
+        prof.count('scope.lookup_parents')
+        return self.parent._lookup(tn, colname, depth+1)
 
     def __repr__(self):
         return '<%s>' % self._repr(self)
@@ -61,6 +71,7 @@ class scope(object):
 @show()
 def lookup(sc, name):
     """Look up a name into the specified scope."""
+    prof.count('scope.lookups')
     if '.' in name:
         tn, colname = name.split('.', 1)
         return sc._lookup(tn, colname)
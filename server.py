@@ -0,0 +1,269 @@
+"""
+A server that runs the analyzer as a long-lived process.
+
+It can be launched with
+
+   python3 sql.py --serve unix:/path/to/socket
+   python3 sql.py --serve tcp:5432            (on localhost)
+   python3 sql.py --serve tcp:HOST:5432
+
+Clients send one S-expression query per line. For each query, the
+server sends back one line with a JSON object: {"result": <text>} with
+the text printed by the handler (the memo and expression tree), or
+{"error": <message>}.
+
+Clients can send several queries without waiting for the responses
+(pipelining): the queries are processed concurrently by a pool of
+worker processes, so the event loop stays responsive, and the
+responses are sent back in the same order as the queries. When too
+many queries from a connection are in flight, the server stops reading
+from it until some responses have been sent (backpressure).
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import stat
+import threading
+
+# depth is the maximum number of queries from one connection that can
+# be waiting for their response before the server stops reading more.
+depth = 16
+
+# The maximum length of a query line.
+maxline = 16 << 20
+
+# redirect_stdout() replaces sys.stdout for the whole process, so the
+# handlers that run in threads (see start) capture their output one at
+# a time.
+capture = threading.Lock()
+
+def process(handle, line):
+    """Process one query and return the response object.
+
+    This runs in a worker: the output of the handler is captured
+    instead of being printed.
+
+    >>> from sql import handle_sql
+    >>> process(handle_sql, '(select :from kv)')['result'].split('\\n')[0]
+    'memo after analysis:'
+    >>> process(handle_sql, '(select :from foo)')
+    {'error': 'unknown table: foo'}
+    >>> process(handle_sql, '(select')
+    {'error': 'invalid query: (select'}
+    >>> process(handle_sql, 'foo')
+    {'error': 'AssertionError'}
+    >>> process(lambda q: {}[q[0]], '(0)')
+    {'error': 'KeyError: 0'}
+    """
+    from sqlio import loads
+    try:
+        q = loads(line)
+    except Exception:
+        return {'error': 'invalid query: %s' % line}
+    buf = io.StringIO()
+    try:
+        with capture, contextlib.redirect_stdout(buf):
+            handle(q)
+    except Exception as e:
+        return {'error': errormessage(e)}
+    return {'result': buf.getvalue()}
+
+def errormessage(e):
+    """The message sent to the client for an exception.
+
+    The errors raised by the analyzer are plain exceptions whose text
+    is the message. For the others, e.g. a KeyError whose text is only
+    the missing key, the type of the exception is included.
+
+    >>> errormessage(Exception('unknown table: foo'))
+    'unknown table: foo'
+    >>> errormessage(KeyError(0))
+    'KeyError: 0'
+    >>> errormessage(AssertionError())
+    'AssertionError'
+    """
+    msg = str(e)
+    if type(e) is Exception and msg != '':
+        return msg
+    elif msg == '':
+        return e.__class__.__name__
+    return '%s: %s' % (e.__class__.__name__, msg)
+
+async def handle_conn(handle, pool, limit, reader, writer):
+    """Serve the queries sent over one connection."""
+    loop = asyncio.get_running_loop()
+    # pending holds the queries being processed, in order. Since it
+    # is bounded, reading stops when it is full.
+    pending = asyncio.Queue(maxsize=depth)
+
+    async def respond():
+        while True:
+            fut = await pending.get()
+            if fut is None:
+                break
+            try:
+                resp = await fut
+            except Exception as e:
+                # The worker could not process the query, e.g. because
+                # the pool is broken.
+                resp = {'error': errormessage(e)}
+            writer.write((json.dumps(resp) + '\n').encode())
+            await writer.drain()
+
+    def answered(resp):
+        fut = loop.create_future()
+        fut.set_result(resp)
+        return fut
+
+    def submit(line):
+        try:
+            return loop.run_in_executor(pool, process, handle, line)
+        except Exception as e:
+            return answered({'error': errormessage(e)})
+
+    responder = asyncio.ensure_future(respond())
+    # If the responder fails (e.g. the connection is lost), stop
+    # reading: nothing would empty the queue anymore.
+    reading = asyncio.current_task()
+    responder.add_done_callback(lambda t: t.cancelled() or t.exception() is None or reading.cancel())
+    try:
+        while not responder.done():
+            try:
+                line = await reader.readline()
+            except (ValueError, asyncio.LimitOverrunError):
+                # The rest of the stream cannot be split into queries
+                # reliably: report the error and stop reading.
+                await pending.put(answered({'error': 'query too long (more than %d bytes)' % limit}))
+                break
+            if len(line) == 0:
+                break
+            line = line.decode().strip()
+            if line == '':
+                continue
+            await pending.put(submit(line))
+        await pending.put(None)
+        await responder
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        responder.cancel()
+        await asyncio.gather(responder, return_exceptions=True)
+        writer.close()
+
+async def start(address, handle, pool, limit=maxline):
+    """Start serving on the given address, and return the asyncio server.
+
+    If pool is None, the queries are processed in threads
+    instead of worker processes, one at a time since their output is
+    captured from the process's stdout (see capture). limit is the
+    maximum length of a query line.
+
+    >>> import os, tempfile
+    >>> from sql import handle_sql
+    >>> async def demo(address):
+    ...     server = await start(address, handle_sql, None)
+    ...     async with server:
+    ...         return await client(address, ['(select :from kv)', '(select :exprs bad)'])
+    >>> path = os.path.join(tempfile.mkdtemp(), 'sock')
+    >>> res = asyncio.run(demo('unix:' + path))
+    >>> res[0]['result'].split('\\n')[:2], res[1]
+    (['memo after analysis:', '<memo'], {'error': "unknown column: Symbol('bad')"})
+
+    The output of the queries processed concurrently is not mixed:
+
+    >>> import time
+    >>> def slow(q):
+    ...     for _ in range(3):
+    ...         print(q[0])
+    ...         time.sleep(0.01)
+    >>> async def many(address):
+    ...     server = await start(address, slow, None)
+    ...     async with server:
+    ...         return await client(address, ['(%d)' % i for i in range(4)])
+    >>> [r['result'] for r in asyncio.run(many('unix:' + path))]
+    ['0\\n0\\n0\\n', '1\\n1\\n1\\n', '2\\n2\\n2\\n', '3\\n3\\n3\\n']
+
+    A query longer than the limit gets an error response, after the
+    responses to the queries before it:
+
+    >>> async def toolong(address):
+    ...     server = await start(address, handle_sql, None, limit=100)
+    ...     async with server:
+    ...         return await client(address, ['(select :from kv)', '(select :from %s)' % ('x' * 200)])
+    >>> res = asyncio.run(toolong('unix:' + path))
+    >>> 'result' in res[0], res[1]
+    (True, {'error': 'query too long (more than 100 bytes)'})
+    """
+    cb = lambda r, w: handle_conn(handle, pool, limit, r, w)
+    kind, where, port = parse_address(address)
+    if kind == 'unix':
+        with contextlib.suppress(FileNotFoundError):
+            if stat.S_ISSOCK(os.stat(where).st_mode):
+                # Left over by a previous server.
+                os.unlink(where)
+        return await asyncio.start_unix_server(cb, where, limit=limit)
+    return await asyncio.start_server(cb, where, port, limit=limit)
+
+def parse_address(address):
+    """Split an address into (kind, path or host, port).
+
+    >>> parse_address('unix:/tmp/sql.sock')
+    ('unix', '/tmp/sql.sock', None)
+    >>> parse_address('tcp:5432')
+    ('tcp', 'localhost', 5432)
+    >>> parse_address('tcp:127.0.0.1:5432')
+    ('tcp', '127.0.0.1', 5432)
+    """
+    kind, _, rest = address.partition(':')
+    if kind == 'unix' and rest != '':
+        return kind, rest, None
+    elif kind == 'tcp' and rest != '':
+        host, port = 'localhost', rest
+        if ':' in rest:
+            host, port = rest.rsplit(':', 1)
+        return kind, host, int(port)
+    raise Exception("invalid address: %s (expected unix:PATH or tcp:[HOST:]PORT)" % address)
+
+def serve(address, handle, workers=None):
+    """Serve queries on the given address until interrupted.
+
+    The handler must be a module-level function, so that it can be
+    sent to the worker processes.
+    """
+    async def run():
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            server = await start(address, handle, pool)
+            print("serving on", address)
+            async with server:
+                await server.serve_forever()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+async def client(address, queries):
+    """Send queries to a server, and return the list of responses.
+
+    All the queries are sent before reading the responses.
+    """
+    kind, where, port = parse_address(address)
+    if kind == 'unix':
+        reader, writer = await asyncio.open_unix_connection(where, limit=maxline)
+    else:
+        reader, writer = await asyncio.open_connection(where, port, limit=maxline)
+    for q in queries:
+        writer.write((q + '\n').encode())
+    await writer.drain()
+    res = [json.loads(await reader.readline()) for q in queries]
+    writer.close()
+    return res
+
+if __name__ == "__main__":
+    print("testing...")
+    import doctest
+    doctest.testmod()
+    print("testing done")
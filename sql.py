@@ -50,15 +50,48 @@ Some other examples that can be fed to this analyzer:
 # SELECT x AS k FROM (SELECT v AS x FROM kv)
 (select :exprs [(:k x)] :from (select :exprs [(:x v)] :from kv))
 
+# SELECT k, a FROM kv, LATERAL (SELECT a FROM ab WHERE b > v)
+(select :exprs [k a] :from [kv (lateral (select :exprs a :from ab :where (> b v)))])
+
+# EXPLAIN ANALYZE SELECT k FROM kv WHERE v > 15
+(explain analyze (select :exprs k :from kv :where (> v 15)))
+
 """
 
-import sexpdata
 from sexpdata import Symbol as S
 from show import show
+import prof
+import mem
 from scope import scope,lookup
 from sqlio import *
-from memo import memo, print_tree
+from memo import memo, print_tree, conjuncts, compact, fingerprint, merge, provided
+from catalog import tables, has_index
+import run
 import io
+import sys
+
+# _session is the incremental analysis in progress, if any. See
+# incremental below.
+_session = None
+
+def reusable(*kinds, rebind=None):
+    """Decorator for the analysis functions whose results can be
+    reused by an incremental analysis.
+
+    Only the expressions of the given types are considered. If rebind
+    is specified, it is called with (memo, env, exp, idx) when a
+    previous result is reused, to replay the side effects of the
+    analysis on the naming scope.
+    """
+    def wrap(func):
+        def analyze_or_reuse(memo, env, exp):
+            if _session is None or not isinstance(exp, kinds):
+                return func(memo, env, exp)
+            return _session.visit(func, rebind, memo, env, exp)
+        analyze_or_reuse.__name__ = func.__name__
+        analyze_or_reuse.__doc__ = func.__doc__
+        return analyze_or_reuse
+    return wrap
 
 @show(memo)
 def add_scalar_exp(memo, mexpr, props):
@@ -76,6 +109,8 @@ def add_scalar_exp(memo, mexpr, props):
     return memo.newcls(mexpr, props)
 
 @show(memo,scope)
+@prof.phase('analyze_scalar')
+@reusable(Exp)
 def analyze_scalar(memo, env, exp):
     """Analyzes a scalar expression and populates the memo accordingly.
 
@@ -94,12 +129,21 @@ def analyze_scalar(memo, env, exp):
         idx = lookup(env, exp.value())
         if idx is None:
             throw("unknown column: %s" % exp)
+        if _session is not None:
+            _session.note([(exp.value(), idx)])
         return idx
 
     elif isinstance(exp, int):
         # A literal: add it to the memo. No column is needed.
         return add_scalar_exp(memo, Exp('lit', [exp]), {'neededcols':Set()})
 
+    elif op(exp) == 'param':
+        # A placeholder (param N) for the N-th parameter bound at
+        # execution time. Like a literal, no column is needed.
+        if not isinstance(exp.args, list) or len(exp.args) != 1 or not isinstance(exp.args[0], int):
+            throw("invalid placeholder: %s" % dumps(exp))
+        return add_scalar_exp(memo, Exp('param', exp.args), {'neededcols':Set()})
+
     elif op(exp) == 'exists':
         # EXISTS(...subquery...)
         #
@@ -110,6 +154,9 @@ def analyze_scalar(memo, env, exp):
         # usually empty, except for correlated subqueries.
         #
         idx = analyze_select(memo, env, exp.args[0])
+        if len(memo[idx].props.neededcols) == 0:
+            # Not correlated: share it with identical subqueries.
+            idx = share(memo, idx)
         return add_scalar_exp(memo, Exp('exists', [idx]),
                               {'neededcols':memo[idx].props.neededcols})
 
@@ -121,6 +168,8 @@ def analyze_scalar(memo, env, exp):
         # refers to it.
         # Same handling as EXISTS above, really.
         idx = analyze_select(memo, env, exp)
+        if len(memo[idx].props.neededcols) == 0:
+            idx = share(memo, idx)
         return add_scalar_exp(memo, Exp('apply', [idx]),
                               {'neededcols':memo[idx].props.neededcols})
 
@@ -176,6 +225,8 @@ def add_rel_exp(memo, mexpr, props):
 
 
 @show(memo,scope)
+@prof.phase('analyze_select')
+@reusable(Exp)
 def analyze_select(memo, env, exp):
     """Analyzes a SELECT relational expression and populates the memo accordingly.
 
@@ -219,11 +270,13 @@ def analyze_select(memo, env, exp):
         # The columns provided by the source are substracted from the
         # needed columns in the filter to determine the remaining
         # needed columns after the filter stage.
+        neededcols = memo[fidx].props.neededcols.difference(provided(memo, srcidx))
+        neededcols.update(memo[srcidx].props.neededcols)
         srcidx = add_rel_exp(memo, Exp('filter', [srcidx, fidx]),
                              {'cols': memo[srcidx].props.cols,
                               'outs': memo[srcidx].props.outs,
                               'labels': memo[srcidx].props.labels,
-                              'neededcols':memo[fidx].props.neededcols.difference(memo[srcidx].props.cols),
+                              'neededcols':neededcols,
                              })
 
     # XXX: we don't support GROUP BY here yet.
@@ -290,11 +343,14 @@ def analyze_select(memo, env, exp):
             # Like for the filter node, the needed columns
             # (correlation dependencies) for the projection is the
             # union of needed columns for the projection expressions,
-            # minus the columns provided by this SELECT clause.
+            # minus the variables provided by its source.
+            neededcols = Set(memo[srcidx].props.neededcols)
+            for i in idxs:
+                neededcols.update(memo[i].props.neededcols)
             srcidx = add_rel_exp(memo, Exp('project', [srcidx]),
                                  {'cols':idxs, 'outs':outs,
                                   'labels':labels,
-                                  'neededcols':memo[srcidx].props.neededcols.difference(outs),
+                                  'neededcols':neededcols.difference(provided(memo, srcidx)),
                                  })
 
     # XXX: we don't support ORDER BY here yet.
@@ -305,16 +361,8 @@ def analyze_select(memo, env, exp):
     return srcidx
 
 
-# tables is the list of tables known for the purpose
-# of schema resolution in FROM clauses (get_datasource below).
-tables = {
-    # ... Some fake table schema ...
-    # (for testing)
-    'kv': ('k', 'v'),
-    'ab': ('a', 'b'),
-}
-
 @show(memo,scope)
+@prof.phase('analyze_from')
 def analyze_from(memo, env, exp):
     """Analyzes a FROM clause.
 
@@ -322,26 +370,85 @@ def analyze_from(memo, env, exp):
 
     However, FROM a,b,c is really equivalent to FROM a CROSS JOIN b
     CROSS JOIN c. We handle that in analyze_from().
+
+    An item of the list can also be (lateral <source>), which can
+    refer to the columns of the items before it. FROM a, LATERAL b
+    is then analyzed as a lateral join between a and b.
     """
     if not isinstance(exp, list):
         # Common case: delegate to get_datasource() below.
+        if op(exp) == 'lateral':
+            exp = lateral_source(exp)
         return get_datasource(memo, env, exp)
 
     # Otherwise: cross-join in disguise.
-    idxs, lbls, cols, outs = [], [], [], Set()
+    idxs, lateral = [], False
     for e in exp:
-        idx = get_datasource(memo, env, e)
-        idxs.append(idx)
+        if op(e) == 'lateral' and len(idxs) == 0:
+            # Nothing before it: this is a plain source.
+            e = lateral_source(e)
+        if op(e) == 'lateral':
+            # The lateral source sees the names defined by the sources
+            # before it, so it is analyzed in the current scope.
+            idx = get_datasource(memo, env, lateral_source(e))
+            left = idxs[0] if len(idxs) == 1 else add_join(memo, 'cross', idxs)
+            idxs, lateral = [add_join(memo, 'lateral', [left, idx])], True
+            continue
+
+        # The other sources do not see the names defined by the sources
+        # before them: analyze them in a scope of their own, then make
+        # their names available in the current scope.
+        sub = scope(env.parent)
+        idxs.append(get_datasource(memo, sub, e))
+        for tn, cols in sub.scope.items():
+            for colname, idx in cols.items():
+                env.bind(tn, colname, idx)
+
+    if lateral and len(idxs) == 1:
+        return idxs[0]
+    return add_join(memo, 'cross', idxs)
+
+def lateral_source(exp):
+    """Extracts the source from a (lateral <source>) FROM item."""
+    if not isinstance(exp.args, list) or len(exp.args) != 1:
+        throw("expected (lateral <source>): %s" % dumps(exp))
+    return exp.args[0]
+
+def add_join(memo, joinop, idxs):
+    """Adds a join of the given sources into the memo.
+
+    The join provides the columns of all its sources. Its needed columns
+    are those needed by the sources, minus the variables provided by the
+    sources themselves (see provided()): for a lateral join, the right
+    source can need the columns of the left source.
+
+    >>> m = analyze(loads('(select :from [(select :exprs [(:x (+ k 1))] :from kv) (lateral (select :exprs [(:y (+ x a))] :from ab))])'))
+    >>> len(m[m.root].props.neededcols)
+    0
+    """
+    lbls, cols, outs, needed, provides = [], [], Set(), Set(), Set()
+    for idx in idxs:
         lbls.extend(memo[idx].props.labels)
         cols.extend(memo[idx].props.cols)
         outs.update(memo[idx].props.outs)
-        # XXX: need to collect names and needed columns side-ways
-        # to support lateral (correlated) joins.
+        needed.update(memo[idx].props.neededcols)
+        provides.update(provided(memo, idx))
+    return add_rel_exp(memo, Exp(joinop, idxs),
+                       {'cols':cols, 'outs':outs,'labels':lbls,'neededcols':needed.difference(provides)})
 
-    return add_rel_exp(memo, Exp('cross', idxs),
-                       {'cols':cols, 'outs':outs,'labels':lbls,'neededcols':Set()})
+def bind_source(memo, env, exp, idx):
+    """Makes the columns of a FROM source available in the naming scope.
+
+    This is used by get_datasource() below when the source was analyzed
+    previously (see incremental).
+    """
+    p = memo[idx].props
+    tn = exp.value() if isinstance(exp, S) else ''
+    for l, c in zip(p.labels, p.cols):
+        env.bind(tn, l, c)
 
 @show(memo,scope)
+@reusable(Exp, S, rebind=bind_source)
 def get_datasource(memo, env, exp):
     """Analyzes a relational expression in a FROM clause.
 
@@ -392,30 +499,539 @@ def get_datasource(memo, env, exp):
         outs = memo[srcidx].props.outs
         memo[srcidx].props.neededcols.difference_update(outs)
 
+        # If the same subquery, not correlated, was analyzed before,
+        # its results can be reused. The class itself cannot be shared,
+        # because its columns must remain distinct, so we add an
+        # alternative instead.
+        if len(memo[srcidx].props.neededcols) == 0 and memo[srcidx].mexprs[0].op not in ['scan', 'unary']:
+            j = share(memo, srcidx)
+            if j != srcidx:
+                memo[srcidx].mexprs.append(Exp('shared', [j]))
+
         return srcidx
 
     throw("unknown from clause: %r" % exp)
 
+def share(memo, idx):
+    """Finds a subquery identical to the one at index idx, analyzed before.
+
+    The result is the index of the class of that subquery, or idx if
+    there is none. The subquery must not be correlated.
+
+    For example, the two occurrences of the subquery below use the same
+    class:
+
+    >>> m = analyze(loads('(select :exprs (select :exprs a :from ab) :from kv :where (exists (select :exprs a :from ab)))'))
+    >>> m[m.root].props.cols, m[m.root].mexprs[0].args
+    ([6], [5])
+    >>> m[6], m[4]
+    (<cls (apply 3)                                (:neededcols {})>, <cls (exists 3)                               (:neededcols {})>)
+    """
+    return memo.shared.setdefault(fingerprint(memo, idx), idx)
+
+@prof.phase('explore')
+def explore(memo, start=0):
+    """Explores alternative strategies for the classes in the memo.
+
+    This is run once after analysis, over the classes from index start
+    onwards. Each alternative is added as an extra m-expression to the
+    class it implements.
+
+    Currently the only alternative considered is an index scan instead
+    of a filter directly above a table scan, when the filter compares
+    an indexed column with a literal. For example:
+
+    >>> m = memo()
+    >>> m.root = analyze_select(m, scope(None), loads('(select :from kv :where (= v 20))'))
+    >>> explore(m)
+    >>> m[m.root]
+    <cls (filter 2 4) (indexscan :table "kv" :col "v" :lo 20 :hi 20 :bounds "[]") (:cols (0 1) :outs {0 1} :labels ("k" "v") :neededcols {})>
+
+    When only some of the conditions can use the index, the others remain
+    in a filter above the index scan:
+
+    >>> m = memo()
+    >>> m.root = analyze_select(m, scope(None), loads('(select :from kv :where (and (> v 10) (< k 4)))'))
+    >>> explore(m)
+    >>> m[m.root].mexprs[1]
+    Exp('filter', [9, 6])
+    >>> m[9]
+    <cls (indexscan :table "kv" :col "v" :lo 10 :bounds "()") (:cols (0 1) :outs {0 1} :labels ("k" "v") :neededcols {})>
+    """
+    for idx in range(start, len(memo.classes)):
+        e = memo[idx].mexprs[0]
+        if len(memo[idx].mexprs) > 1:
+            # Already explored, or shared with another class.
+            continue
+        if e.op == 'filter' and memo[e.args[0]].mexprs[0].op == 'scan':
+            explore_indexscan(memo, idx)
+
+def explore_indexscan(memo, idx):
+    """Adds an index scan alternative to a filter over a scan, if possible."""
+    srcidx, fidx = memo[idx].mexprs[0].args
+    tn = memo[srcidx].mexprs[0].args[0]
+
+    # Split the filter condition into its conjuncts, and find the
+    # range of values each one allows over an indexed column.
+    sargs, rest = [], []
+    for c in conjuncts(memo, fidx):
+        sarg = get_range(memo, c, memo[srcidx].props.cols)
+        if sarg is None or not has_index(tn, sarg[0]):
+            rest.append(c)
+        else:
+            sargs.append((c, sarg))
+    if len(sargs) == 0:
+        return
+
+    # Use the index over the first constrained column, intersecting
+    # the ranges of all the conditions over it. The conditions over
+    # other columns remain in the filter.
+    colname = sargs[0][1][0]
+    lo, hi = None, None
+    for c, (cn, clo, chi) in sargs:
+        if cn != colname:
+            rest.append(c)
+            continue
+        lo = tighter(lo, clo, max)
+        hi = tighter(hi, chi, min)
+    rng = Props({'table': tn, 'col': colname})
+    if lo is not None:
+        rng.lo = lo[0]
+    if hi is not None:
+        rng.hi = hi[0]
+    rng.bounds = ('[' if lo is not None and lo[1] else '(') + \
+                 (']' if hi is not None and hi[1] else ')')
+
+    if len(rest) == 0:
+        # The index scan computes the filter entirely.
+        memo[idx].mexprs.append(Exp('indexscan', rng))
+        return
+
+    # Otherwise, filter the results of the index scan with the
+    # remaining conditions.
+    p = memo[srcidx].props
+    isidx = add_rel_exp(memo, Exp('indexscan', rng),
+                        {'cols':p.cols,'outs':p.outs,'labels':p.labels,'neededcols':p.neededcols})
+    if len(rest) == 1:
+        ridx = rest[0]
+    else:
+        neededcols = Set()
+        for i in rest:
+            neededcols.update(memo[i].props.neededcols)
+        ridx = add_scalar_exp(memo, Exp('and', rest), {'neededcols':neededcols})
+    memo[idx].mexprs.append(Exp('filter', [isidx, ridx]))
+
+# The comparisons an index can serve, and their mirror image
+# when the literal is on the left.
+rangeops = {'=': '=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+def get_range(memo, idx, cols):
+    """Recognizes a comparison between a column and a literal.
+
+    The column must be one of the given (scanned) columns. The result
+    is (colname, lo, hi), where lo and hi are each either None or a
+    pair (value, inclusive). If the condition is not a comparison
+    between a column and a literal, the result is None.
+    """
+    e = memo[idx].mexprs[0]
+    if e.op not in rangeops or len(e.args) != 2:
+        return None
+    a, b = e.args
+    cmp = e.op
+    if memo[a].mexprs[0].op == 'lit':
+        a, b, cmp = b, a, rangeops[cmp]
+    if a not in cols or memo[a].mexprs[0].op != 'var' or memo[b].mexprs[0].op != 'lit':
+        return None
+    colname = memo[a].mexprs[0].args[0].split('.', 1)[1]
+    v = memo[b].mexprs[0].args[0]
+    if cmp == '=':
+        return colname, (v, True), (v, True)
+    elif cmp in ['<', '<=']:
+        return colname, None, (v, cmp == '<=')
+    return colname, (v, cmp == '>='), None
+
+def tighter(a, b, pick):
+    """Combines two bounds, keeping the most restrictive one."""
+    if a is None:
+        return b
+    if b is None or a[0] != b[0]:
+        return a if b is None or pick(a[0], b[0]) == a[0] else b
+    # Same value: the bound is inclusive only if both are.
+    return (a[0], a[1] and b[1])
+
 def tocolname(exp):
-    """Generates a label for a projection column."""
-    return sexpdata.dumps(exp)
+    """Generates a label for a projection column.
+
+    The labels are interned: the same expressions used in many
+    queries share the same label string.
+    """
+    return sys.intern(dumps(exp))
+
+def analyze(exp):
+    """Analyzes a SELECT expression into a new memo, and returns the memo.
+
+    For example, a FROM item can only refer to the columns of the items
+    before it if it is lateral:
+
+    >>> m = analyze(loads('(select :from [kv (select :exprs a :from ab :where (= a k))])'))
+    Traceback (most recent call last):
+    ...
+    Exception: unknown column: Symbol('k')
+    >>> m = analyze(loads('(select :from [kv (lateral (select :exprs a :from ab :where (= a k)))])'))
+    >>> m[m.root]
+    <cls (lateral 2 7)                            (:cols (0 1 3) :outs {0 1 3} :labels ("k" "v" "a") :neededcols {})>
+    >>> m[7]
+    <cls (project 6)                              (:cols (3) :outs {3} :labels ("a") :neededcols {0})>
+
+    A lateral item in first position is a plain source:
+
+    >>> m = analyze(loads('(select :from [(lateral (select :exprs k :from kv)) ab])'))
+    >>> m[m.root].mexprs[0]
+    Exp('cross', [2, 5])
+    """
+    m = memo()
+    m.root = analyze_select(m, scope(None), exp)
+    compact(m)
+    explore(m)
+    return m
+
+def analyze_batch(exps):
+    """Analyzes a list of SELECT expressions into a single memo, and returns the memo.
+
+    The memo has one root per query (see memo.merge). The parts that
+    the queries have in common, like their scans and the filters over
+    them, are shared: they are executed only once for the whole batch
+    by run.execute_batch().
+
+    >>> m = analyze_batch([loads('(select :exprs k :from kv :where (> v 15))'),
+    ...                    loads('(select :exprs v :from kv :where (> v 15))')])
+    >>> m.roots
+    [6, 7]
+    >>> m[6].mexprs[0].args == m[7].mexprs[0].args
+    True
+    """
+    m, table = memo(), {}
+    m.roots = []
+    for exp in exps:
+        q = memo()
+        q.root = analyze_select(q, scope(None), exp)
+        m.roots.append(merge(m, q, table))
+    compact(m)
+    explore(m)
+    return m
+
+class record(object):
+    """The result of the analysis of one sub-expression.
+
+    - start: the size of the memo when the analysis started. The
+      classes created for the sub-expression are at that index and
+      after.
+    - idx: the resulting memo index.
+    - lookups: the (name, idx) pairs of the column references that
+      resolved to classes created before start. The result remains
+      valid as long as these names still resolve to the same classes.
+    """
+    def __init__(self, start):
+        self.start = start
+        self.idx = None
+        self.lookups = []
+
+class incremental(object):
+    """An object that analyzes successive, similar queries.
+
+    All the queries are analyzed into the same memo. The parsed
+    expression of each query is compared to the previous one, and the
+    memo classes of the sub-expressions that did not change (FROM
+    sources, subqueries, scalar expressions) are reused instead of
+    being analyzed again. Only the new classes are explored. The
+    classes that are not used any more are then removed from the memo.
+
+    >>> s = incremental()
+    >>> m = s.analyze(loads('(select :exprs k :from kv :where (> v 10))'))
+    >>> m = s.analyze(loads('(select :exprs k :from kv :where (> v 20))'))
+    >>> s.reused
+    1
+    >>> print(m)
+    <memo
+    root: 6
+     0 <cls (var "kv.k")                             (:neededcols {0})>
+     1 <cls (var "kv.v")                             (:neededcols {1})>
+     2 <cls (scan "kv")                              (:cols (0 1) :outs {0 1} :labels ("k" "v") :neededcols {})>
+     3 <cls (lit 20)                                 (:neededcols {})>
+     4 <cls (> 1 3)                                  (:neededcols {1})>
+     5 <cls (filter 2 4) (indexscan :table "kv" :col "v" :lo 20 :bounds "()") (:cols (0 1) :outs {0 1} :labels ("k" "v") :neededcols {})>
+     6 <cls (project 5)                              (:cols (0) :outs {0} :labels ("k") :neededcols {})>
+    >
+    >>> run.execute(m)
+    [(4,), (5,)]
+
+    A sub-expression is only reused if its column references still
+    resolve to the same classes:
+
+    >>> m = s.analyze(loads('(select :exprs (+ v 1) :from kv)'))
+    >>> m = s.analyze(loads('(select :exprs (+ v 1) :from (select :exprs [(:v k)] :from kv))'))
+    >>> s.reused, run.execute(m)
+    (0, [(2,), (3,), (4,), (5,), (6,)])
+
+    When the analysis of a query fails, e.g. because the memo exceeds
+    the memory budget, the classes it added are removed:
+
+    >>> mem.budget = 20000
+    >>> m = s.analyze(loads('(select :exprs [(+ k 1) (+ k 2) (+ k 3) (+ k 4) (+ k 5) (+ k 6) (+ k 7) (+ k 8) (+ k 9)] :from [kv ab])'))
+    Traceback (most recent call last):
+    ...
+    MemoryError: the memo exceeds the memory budget (20000 bytes)
+    >>> run.execute(s.analyze(loads('(select :exprs v :from kv)')))
+    [(10,), (20,), (20,), (30,), (40,)]
+    >>> mem.budget = None
+    """
+    def __init__(self):
+        self.memo = memo()
+        self.exp = None
+        # records maps (function, id(sub-expression)) to the record of
+        # its analysis, for the sub-expressions of self.exp.
+        self.records = {}
+        # reuse maps (function, id(sub-expression)) to the record of
+        # the same sub-expression in the previous query, for the
+        # sub-expressions of the query being analyzed.
+        self.reuse = {}
+        # stack holds the records of the analyses in progress.
+        self.stack = []
+        self.reused = 0
+
+    def analyze(self, exp):
+        """Analyzes a SELECT expression, and returns the memo."""
+        global _session
+        self.reuse, self.reused = {}, 0
+        if self.exp is not None:
+            self.diff(self.exp, exp)
+        m, start, records = self.memo, len(self.memo.classes), self.records
+        size, shared = m.size, dict(m.shared)
+        self.records = {}
+        _session = self
+        try:
+            m.root = analyze_select(m, scope(None), exp)
+        except:
+            # Forget the classes of the failed analysis, e.g. when the
+            # memo exceeded the memory budget.
+            del m.classes[start:]
+            m.size, m.shared = size, shared
+            self.records = records
+            raise
+        finally:
+            _session = None
+            self.stack = []
+        self.exp = exp
+        mapping, pruned = compact(m)
+        self.remap(mapping, pruned)
+        explore(m, sum(1 for i in mapping if i < start))
+        return m
+
+    def remap(self, mapping, pruned):
+        """Updates the records after the memo was compacted.
+
+        The records of the classes that were removed, or whose columns
+        were removed, are forgotten.
+        """
+        records = {}
+        for key, r in self.records.items():
+            if r.idx not in mapping or r.idx in pruned or any(i not in mapping for _, i in r.lookups):
+                continue
+            n = record(None)
+            n.idx = mapping[r.idx]
+            n.lookups = [(name, mapping[i]) for name, i in r.lookups]
+            records[key] = n
+        self.records = records
+
+    def diff(self, old, new):
+        """Compares two expressions positionally, and registers the
+        records of the sub-expressions of old that can be reused
+        for the same sub-expressions of new.
+
+        The result is whether old and new are equal.
+        """
+        if isinstance(new, Exp):
+            same = isinstance(old, Exp) and old.op == new.op and self.diff(old.args, new.args)
+        elif isinstance(new, list):
+            same = isinstance(old, list) and len(old) == len(new)
+            if isinstance(old, list):
+                for o, n in zip(old, new):
+                    same = self.diff(o, n) and same
+        elif isinstance(new, dict):
+            same = isinstance(old, dict) and old.keys() == new.keys()
+            if isinstance(old, dict):
+                for k in new:
+                    if k in old:
+                        same = self.diff(old[k], new[k]) and same
+        else:
+            same = type(old) == type(new) and old == new
+        if same:
+            for name in ('analyze_scalar', 'analyze_select', 'get_datasource'):
+                r = self.records.get((name, id(old)), None)
+                if r is not None:
+                    self.reuse[(name, id(new))] = r
+        return same
+
+    def visit(self, func, rebind, memo, env, exp):
+        """Analyzes a sub-expression with func, or reuses the result
+        of its previous analysis."""
+        key = (func.__name__, id(exp))
+        r = self.reuse.get(key, None)
+        if r is not None and all(lookup(env, n) == i for n, i in r.lookups):
+            prof.count('incremental.reused')
+            self.reused += 1
+            if rebind is not None:
+                rebind(memo, env, exp, r.idx)
+        else:
+            r = record(len(memo.classes))
+            self.stack.append(r)
+            try:
+                r.idx = func(memo, env, exp)
+            finally:
+                self.stack.pop()
+        self.records[key] = r
+        self.note(r.lookups)
+        return r.idx
+
+    def note(self, lookups):
+        """Registers column references made by the sub-expression being analyzed."""
+        if len(self.stack) > 0:
+            r = self.stack[-1]
+            r.lookups.extend(l for l in lookups if l[1] < r.start)
 
 def handle_sql(exp):
     """Function to handle one input S-expression.
 
     This prepares the expression, then prints the memo
     and expression tree.
+
+    With (explain analyze <select>), the query is also executed and the
+    expression tree is annotated with the statistics collected during
+    execution, followed by the results:
+
+    >>> handle_sql(loads('(explain analyze (select :exprs k :from kv :where (= v 20)))'))
+    ... # doctest: +ELLIPSIS
+    memo after analysis:
+    ...
+    expression tree:
+    ( 6) project
+         ...
+         exprs (@0 kv.k)
+         actual rows=2 batches=1 loops=1 time=...ms mem=...B
+    <BLANKLINE>
+        ( 5) filter
+             ...
+             filter (= (@1 kv.v) 20)
+             alt (indexscan :table "kv" :col "v" :lo 20 :hi 20 :bounds "[]")
+             actual rows=2 batches=1 loops=1 time=...ms mem=...B
+             using alt 1
+    <BLANKLINE>
+            ( 2) scan
+                 ...
+                 table kv
+                 actual never executed (estimated rows=5)
+    <BLANKLINE>
+    results:
+    (2)
+    (3)
+
+    With (batch <select>...), the queries are analyzed into a single
+    memo and share their common parts (see analyze_batch).
     """
+    if op(exp) == 'execute':
+        return handle_execute(exp)
+
+    explain = False
+    if op(exp) == 'explain':
+        if len(exp.args) != 2 or exp.args[0] != S('analyze'):
+            throw("expected (explain analyze <select>): %s" % dumps(exp))
+        explain = True
+        exp = exp.args[1]
 
     # Compile the expression.
-    m = memo()
-    m.root = analyze_select(m, scope(None), exp)
+    batch = op(exp) == 'batch'
+    if batch:
+        if not isinstance(exp.args, list) or len(exp.args) == 0:
+            throw("expected (batch <select>...): %s" % dumps(exp))
+        m = analyze_batch(exp.args)
+    elif session is not None:
+        m = session.analyze(exp)
+    else:
+        m = analyze(exp)
+    mem.note_memo(m)
+
+    # Execute it if requested.
+    stats = None
+    if explain:
+        stats = {}
+        if batch:
+            res = run.execute_batch(m, stats)
+        else:
+            res = [execute(m, stats)]
 
     # Print the results.
     print("memo after analysis:")
     print(m)
     print("expression tree:")
-    print_tree(m)
+    if explain:
+        print_tree(m, run.annotate(m, stats))
+        print("results:")
+        for n, rows in enumerate(res):
+            if batch:
+                print("query %d:" % (n+1))
+            for r in rows:
+                print(dumps(list(r)))
+    else:
+        print_tree(m)
+
+def handle_execute(exp):
+    """Handle (execute <select> <value>...).
+
+    The query is executed with the values bound to its placeholders,
+    and only the results are printed. They are taken from the result
+    cache, if enabled and the same query was executed before.
+
+    >>> handle_sql(loads('(execute (select :exprs k :from kv :where (> v (param 1))) 25)'))
+    results:
+    (4)
+    (5)
+    """
+    if not isinstance(exp.args, list) or len(exp.args) == 0:
+        throw("expected (execute <select> <value>...): %s" % dumps(exp))
+    q, params = exp.args[0], tuple(exp.args[1:])
+    if session is not None:
+        m = session.analyze(q)
+    else:
+        m = analyze(q)
+    mem.note_memo(m)
+    if results is not None:
+        res = results.execute(m, params)
+    else:
+        res = execute(m, None, params)
+    print("results:")
+    for r in res:
+        print(dumps(list(r)))
+
+def execute(m, stats=None, params=()):
+    """Execute the plan in memo m, in parallel if enabled."""
+    if parallelism is None:
+        return run.execute(m, stats, params)
+    # Only pay for loading multiprocessing when it is used.
+    import parallel
+    return parallel.execute(m, workers=parallelism, params=params, stats=stats)
+
+# results, if set, is the cache of query results used by
+# handle_execute() (see cache.py).
+results = None
+
+# parallelism, if set, is the number of worker processes used by
+# handle_sql() to execute each query (see parallel.py).
+parallelism = None
+
+# session, if set, is used by handle_sql() to analyze the queries
+# incrementally. This is enabled in the interactive shell, where
+# successive queries are often small edits of the previous one.
+session = None
 
 # simple helper to simplify the syntax.
 def throw(s):
@@ -429,10 +1045,45 @@ def op(exp):
 
 
 if __name__ == "__main__":
-    print("testing...")
-    import doctest
-    doctest.testmod()
-    print("testing done")
-
-    # Ask sqlio for a main loop, with us as callback.
-    main(handle_sql)
+    test, serve, workers, cachesize = False, None, None, 64
+    if len(sys.argv) > 1:
+        # Only pay for argument parsing when there are arguments.
+        import argparse
+        parser = argparse.ArgumentParser(description='Analyze SQL queries.')
+        parser.add_argument('--test', action='store_true',
+                            help='run the self-tests before starting')
+        parser.add_argument('--serve', metavar='ADDRESS',
+                            help='serve queries on unix:PATH or tcp:[HOST:]PORT')
+        parser.add_argument('--workers', type=int,
+                            help='number of worker processes for --serve')
+        parser.add_argument('--parallel', type=int, metavar='N',
+                            help='execute queries with N worker processes')
+        parser.add_argument('--cache', type=int, metavar='MB', default=64,
+                            help='size of the cache of query results (0 to disable)')
+        parser.add_argument('--mem-budget', type=int, metavar='MB',
+                            help='abort the analysis of queries whose memo exceeds this size')
+        args = parser.parse_args()
+        test, serve, workers = args.test, args.serve, args.workers
+        parallelism = args.parallel
+        cachesize = args.cache
+        if args.mem_budget is not None:
+            mem.budget = args.mem_budget << 20
+
+    if test:
+        print("testing...")
+        import doctest
+        doctest.testmod()
+        print("testing done")
+
+    if cachesize > 0:
+        from cache import resultcache
+        results = resultcache(cachesize << 20, execute)
+
+    if serve is not None:
+        # Run as a server, with us as callback.
+        import server
+        server.serve(serve, handle_sql, workers)
+    else:
+        # Ask sqlio for a main loop, with us as callback.
+        session = incremental()
+        main(handle_sql)
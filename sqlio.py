@@ -1,11 +1,67 @@
 import sexpdata
 from sexpdata import Symbol as S
 from show import set_tracing
+import prof
+import mem
 
 def printexp(exp):
     """Print a S-expression to the screen."""
-    print(sexpdata.dumps(exp))
-
+    print(dumps(exp))
+
+# Escapes for strings and symbols, as done by sexpdata.
+_strquote = str.maketrans(dict((ord(r), q) for r, q in sexpdata.String._lisp_quoted_specials))
+_symquote = str.maketrans(dict((ord(r), q) for r, q in sexpdata.Symbol._lisp_quoted_specials))
+
+def dumps(obj):
+    """Render a value as a S-expression.
+
+    This gives the same result as sexpdata.dumps(), but faster: the
+    types used in the memo (Exp, Props, Set, lists, strings and
+    numbers) are rendered directly. Other types are delegated to
+    sexpdata.
+
+    >>> print(dumps(Exp('f', [1, 'a b', S('x.y'), None, True])))
+    (f 1 "a b" x\\.y () t)
+    >>> dumps(Props({'cols': [1, 2], 'outs': Set([1])}))
+    '(:cols (1 2) :outs {1})'
+    >>> dumps(Exp('select', {'exprs': S('k'), 'from': S('kv')}))
+    '(select :exprs k :from kv)'
+    """
+    f = _dumpers.get(type(obj), None)
+    if f is None:
+        return sexpdata.dumps(obj)
+    return f(obj)
+
+def _dumpseq(l):
+    return '(%s)' % ' '.join([dumps(v) for v in l])
+
+def _dumpdict(d):
+    return '(%s)' % ' '.join([':%s %s' % (k.translate(_symquote), dumps(v)) for k, v in d.items()])
+
+def _dumpexp(e):
+    if e.args is None:
+        return '(%s)' % e.op.translate(_symquote)
+    elif isinstance(e.args, dict):
+        args = _dumpdict(e.args)
+    else:
+        args = _dumpseq(e.args)
+    if len(args) == 2:
+        return '(%s)' % e.op.translate(_symquote)
+    return '(%s %s' % (e.op.translate(_symquote), args[1:])
+
+_dumpers = {
+    int: str,
+    float: str,
+    bool: lambda v: 't' if v else '()',
+    type(None): lambda v: '()',
+    str: lambda v: '"%s"' % v.translate(_strquote),
+    list: _dumpseq,
+    tuple: _dumpseq,
+    dict: _dumpdict,
+    S: lambda v: v.value().translate(_symquote),
+}
+
+@prof.phase('parse')
 def loads(data):
     """Load an S-expression from a string.
 
@@ -59,24 +115,38 @@ def loads(data):
 
 #
 # Let's fix the sexpdata library so that it supports {...} expressions too.
-sexpdata.BRACKETS['{'] = '}'
-import re
+# This is done on first use rather than at import time, so that
+# importing this module has no side effect on sexpdata.
+_syntax = None
+def syntax():
+    """Extend the sexpdata syntax, if not done yet, and return it."""
+    global _syntax
+    if _syntax is None:
+        import re
+        sexpdata.BRACKETS['{'] = '}'
+        closing_brackets = set(sexpdata.BRACKETS.values())
+        atom_end = \
+            set(sexpdata.BRACKETS) | set(closing_brackets) \
+            | set('"\'') | set(sexpdata.whitespace)
+        atom_end_or_escape_re = re.compile("|".join(map(re.escape,
+                                                        atom_end | set('\\'))))
+        _syntax = (closing_brackets, atom_end, atom_end_or_escape_re)
+    return _syntax
+
 def parsesexp(data):
     """Parse a string to a bare S-expression."""
-
     p = sexpdata.Parser(data)
     # We need to re-initialize the sexpdata parser to teach it our new brackets.
-    p.closing_brackets = set(sexpdata.BRACKETS.values())
-    p.atom_end = \
-        set(sexpdata.BRACKETS) | set(p.closing_brackets) \
-        | set('"\'') | set(sexpdata.whitespace)
-    p.atom_end_or_escape_re = re.compile("|".join(map(re.escape,
-                                                      p.atom_end | set('\\'))))
+    p.closing_brackets, p.atom_end, p.atom_end_or_escape_re = syntax()
     return p.parse()
 
 
 class Set(sexpdata.SExpBase):
     """Set values: {x y z}."""
+    # The number of changes made to the set, so that the renderings
+    # cached from it can be invalidated (see memo.cls).
+    _mutations = 0
+
     def __init__(self, val=None):
         if val is None:
             val = set()
@@ -93,19 +163,32 @@ class Set(sexpdata.SExpBase):
         return r
 
     def update(self, s):
+        self._mutations += 1
         if isinstance(s, Set):
             s = s._val
         self._val.update(s)
 
     def difference_update(self, s):
+        self._mutations += 1
         if isinstance(s, Set):
             s = s._val
         self._val.difference_update(s)
 
     def add(self, v):
+        self._mutations += 1
         self._val.add(v)
 
+    def __len__(self):
+        return len(self._val)
+
+    def __iter__(self):
+        return iter(self._val)
+
+    def __contains__(self, v):
+        return v in self._val
+
     def tosexp(self, tosexp=sexpdata.tosexp):
+        syntax()
         return sexpdata.Bracket(list(self.value()), '{').tosexp(tosexp)
 
 class Props(dict):
@@ -129,13 +212,21 @@ class Props(dict):
     def __setattr__(self, k, v):
         if k.startswith('_'):
             k = k[1:]
+        self[k] = v
+
+    # The number of properties set, as for Set above. It is an attribute
+    # and not a property, hence the object.__setattr__ below.
+    _mutations = 0
+
+    def __setitem__(self, k, v):
+        object.__setattr__(self, '_mutations', self._mutations + 1)
         super(Props, self).__setitem__(k, v)
 
     def __hasattr_(self, k):
         return super(Props, self).__hasattr__(k)
 
     def __repr__(self):
-        return sexpdata.tosexp(dict(self))
+        return _dumpdict(self)
 
 class Exp(sexpdata.SExpBase):
     """An expression with a leading operator.
@@ -175,6 +266,10 @@ class Exp(sexpdata.SExpBase):
             ret += self.args
         return tosexp(ret)
 
+_dumpers[Set] = lambda v: '{%s}' % ' '.join([dumps(x) for x in v._val])
+_dumpers[Props] = _dumpdict
+_dumpers[Exp] = _dumpexp
+
 def tryprops(orig, sexp, d):
     if len(sexp) == 0:
         # seen a whole dict, return it
@@ -189,6 +284,7 @@ def tryprops(orig, sexp, d):
     d[l.value()[1:]] = sexp[1]
     return tryprops(orig, sexp[2:], d)
 
+@prof.phase('enrich')
 def enrich(sexp):
     """Extract structures from the S-expression."""
     if isinstance(sexp, list):
@@ -214,43 +310,79 @@ def enrich(sexp):
 
 # Main routine.
 def main(handle):
-    # importing readline is sufficient to activate a CLI.
-    import readline
-    import traceback
-    import os.path
-    histfile = os.path.expanduser("~/.sqlhist")
-    try:
-        readline.read_history_file(histfile)
-    except:
-        pass
+    import contextlib
+    import sys
+    # When the input is not a terminal (e.g. a script), skip the
+    # line editing and history entirely.
+    interactive = sys.stdin.isatty()
+    prompt = "> " if interactive else ""
+    if interactive:
+        # importing readline is sufficient to activate a CLI.
+        import readline
+        import os.path
+        histfile = os.path.expanduser("~/.sqlhist")
+        try:
+            readline.read_history_file(histfile)
+        except:
+            pass
 
     tracing = False
+    # sink receives the profile of each query while profiling is enabled.
+    sink = None
+    # memsink receives the memory report of each query while memory
+    # tracking is enabled.
+    memsink = None
     while True:
         try:
-            line = input("> ")
-            readline.add_history(line)
-            readline.write_history_file(histfile)
+            line = input(prompt)
+            if interactive:
+                readline.add_history(line)
+                readline.write_history_file(histfile)
             if line == '\\trace':
                 tracing = not tracing
                 set_tracing(tracing)
                 continue
+            if line == '\\prof' or line.startswith('\\prof '):
+                # \prof toggles printing the profile of each query;
+                # \prof <file> appends them to a JSON-lines file instead.
+                path = line[len('\\prof'):].strip()
+                if path != '':
+                    sink = prof.jsonsink(path)
+                elif sink is None:
+                    sink = prof.printsink()
+                else:
+                    sink = None
+                continue
+            if line == '\\mem':
+                memsink = mem.printsink() if memsink is None else None
+                continue
 
         except EOFError:
             break
-        try:
-            q = loads(line)
-        except Exception as e:
-            traceback.print_exc()
-            print ("invalid:", line)
-            continue
-
-        printexp(q)
-        print("p:", repr(q))
-        try:
-            handle(q)
-        except Exception as e:
-            traceback.print_exc()
-            continue
+        with contextlib.ExitStack() as stack:
+            if sink is not None:
+                stack.enter_context(prof.profiling(sink))
+            if memsink is not None:
+                stack.enter_context(mem.tracking(memsink))
+            process(handle, line)
+
+def process(handle, line):
+    """Parse one input line and pass it to the handler."""
+    import traceback
+    try:
+        q = loads(line)
+    except Exception as e:
+        traceback.print_exc()
+        print ("invalid:", line)
+        return
+
+    mem.note_exp(q)
+    printexp(q)
+    print("p:", repr(q))
+    try:
+        handle(q)
+    except Exception as e:
+        traceback.print_exc()
 
 if __name__ == "__main__":
     print("testing...")